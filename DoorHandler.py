@@ -1,9 +1,13 @@
 import json
 import time
 from threading import Thread
+from types import SimpleNamespace
 
 import requests
 
+import metrics
+import tracing
+
 
 class DoorHandler:
     unlock_url = 'https://dev.reward.com/crc-door/crc-lock/%d/open/%s?token=pPba48mkqm2RvtTy4PSXNPD8e95D63ajtX57Vfgb'
@@ -27,10 +31,20 @@ class DoorHandler:
             if item is None:
                 break
 
-            person_id, camera_name = item
+            # only what tracing and the latency metric need is sent along with the person, not the face
+            person_id, camera_name, capture_time, trace_id, stage_times = item
+
+            start_time = time.monotonic()
 
             self._send_open_request(person_id, camera_name)
 
+            # the time from reading the frame to opening the door
+            if camera_name in self.door_ids:
+                tracing.record_span(SimpleNamespace(trace_id=trace_id, stage_times=stage_times), 'door_open', start_time)
+
+                if capture_time is not None:
+                    metrics.observe('door_open_latency_seconds', time.time() - capture_time, camera=camera_name)
+
     def _send_open_request(self, person_id, camera_name):
         if camera_name not in self.door_ids:
             return
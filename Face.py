@@ -14,6 +14,16 @@ class Face:
         self.location      = None
         self.timestamp     = None
         self.features      = None
+        self.num_jitters   = None
+
+        # the SharedFaceBuffer slot holding the crop and features, and the (height, width) of the crop
+        self.slot       = None
+        self.crop_shape = None
+
+        # copied from the frame the face was found in, see FrameMetadata
+        self.capture_time = None
+        self.trace_id     = None
+        self.stage_times  = {}
 
     def iou(self, other):
         b1x1 = self.x
@@ -0,0 +1,92 @@
+import numpy as np
+
+
+class FaceClusterer:
+    def __init__(self, min_distance=0.6, block_size=2048):
+        # faces closer than min_distance are joined, and clusters are the connected groups of
+        # joined faces. distances are computed block_size x block_size faces at a time so the
+        # memory used does not grow with the square of the number of faces
+        self.min_distance = min_distance
+        self.block_size   = block_size
+
+    def cluster(self, features_matrix):
+        """Returns a cluster label from 0 to the number of clusters - 1 for each row of the features matrix"""
+        features_matrix = np.asarray(features_matrix, dtype=np.float32)
+
+        count = len(features_matrix)
+
+        if count == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        norms = np.einsum('ij,ij->i', features_matrix, features_matrix)
+
+        # every face points at a face with a lower or equal index in its cluster, the face
+        # pointing at itself being the root of the cluster
+        parents = np.arange(count)
+
+        max_squared_distance = self.min_distance ** 2
+
+        for i in range(0, count, self.block_size):
+            block_i = features_matrix[i:i + self.block_size]
+
+            for j in range(i, count, self.block_size):
+                block_j = features_matrix[j:j + self.block_size]
+
+                squared_distances = norms[i:i + self.block_size, np.newaxis] - 2 * np.dot(block_i, block_j.T) + norms[np.newaxis, j:j + self.block_size]
+
+                a, b = np.nonzero(squared_distances < max_squared_distance)
+
+                parents = self._union(parents, a + i, b + j)
+
+        _, labels = np.unique(self._find_roots(parents), return_inverse=True)
+
+        return labels.reshape(-1)
+
+    def _union(self, parents, a, b):
+        """Join the clusters of every (a, b) pair of faces"""
+        while len(a) > 0:
+            parents = self._find_roots(parents)
+
+            root_a = parents[a]
+            root_b = parents[b]
+
+            # only pairs that are not in the same cluster yet need joining
+            different = root_a != root_b
+
+            a, b = a[different], b[different]
+
+            if len(a) == 0:
+                break
+
+            root_a = root_a[different]
+            root_b = root_b[different]
+
+            # point the higher root at the lower one, several pairs may share a root so the
+            # lowest candidate wins and the rest are joined on the next pass
+            np.minimum.at(parents, np.maximum(root_a, root_b), np.minimum(root_a, root_b))
+
+        return parents
+
+    @staticmethod
+    def _find_roots(parents):
+        """Point every face directly at the root of its cluster"""
+        while True:
+            grandparents = parents[parents]
+
+            if np.array_equal(grandparents, parents):
+                return parents
+
+            parents = grandparents
+
+    @staticmethod
+    def cluster_centroids(features_matrix, labels):
+        """Returns the mean features of each cluster, ordered by label"""
+        features_matrix = np.asarray(features_matrix, dtype=np.float32)
+
+        num_clusters = labels.max() + 1 if len(labels) > 0 else 0
+
+        sums = np.zeros((num_clusters, features_matrix.shape[1]), dtype=np.float64)
+
+        np.add.at(sums, labels, features_matrix)
+
+        return (sums / np.bincount(labels, minlength=num_clusters)[:, np.newaxis]).astype(np.float32)
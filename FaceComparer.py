@@ -2,29 +2,83 @@ import uuid
 
 import numpy as np
 
+from FaceClusterer import FaceClusterer
+
 
 class FaceComparer:
-    def __init__(self, min_distance=0.6):
+    def __init__(self, min_distance=0.6, ambiguous_margin=0.05, refine_distance=0.4):
         self.min_distance = min_distance
 
-    def match_face(self, face, known_people):
-        closest_match    = None
-        closest_distance = float('infinity')
+        # faces matched closer than refine_distance are confident enough to refine the
+        # centroid and templates of the person they matched. None never refines people
+        self.refine_distance = refine_distance
+
+        # distances within ambiguous_margin of min_distance could go either way, so faces
+        # landing there are worth describing more precisely before they are matched
+        self.ambiguous_margin = ambiguous_margin
+
+    def find_closest(self, features, known_people):
+        """Returns the id of the closest person in the known_people Gallery and the distance to them"""
+        # calculate distance between this face and all others at once
+        return known_people.nearest(features)
+
+    def find_closest_batch(self, features_matrix, known_people):
+        """Returns the ids of the closest people to each row of the features matrix and the distances to them"""
+        return known_people.nearest_batch(features_matrix)
 
-        # calculate distance between this face and all others
-        for person_id in known_people:
-            _, person_features = known_people[person_id]
+    def is_ambiguous(self, distance):
+        return abs(distance - self.min_distance) < self.ambiguous_margin
 
-            distance = np.linalg.norm(face.features - person_features)
+    def match_face(self, face, known_people):
+        closest_match, closest_distance = self.find_closest(face.features, known_people)
 
-            if distance < self.min_distance and distance < closest_distance:
-                closest_match    = person_id
-                closest_distance = distance
+        if closest_distance >= self.min_distance:
+            closest_match = None
 
         if closest_match is not None:
             face.person_id = closest_match
+
+            if self.refine_distance is not None and closest_distance < self.refine_distance:
+                known_people.update(closest_match, face.features)
         else:
             face.is_new_person = True
             face.person_id     = str(uuid.uuid4())
 
         return face
+
+    def match_faces(self, features_matrix, known_people):
+        """Match every row of the features matrix against the known people at once. Returns the
+        person id of each row and whether it is the first sighting of a new person. Unmatched
+        rows within min_distance of each other are treated as one new person"""
+        person_ids, distances = self.find_closest_batch(features_matrix, known_people)
+
+        is_new_person = [False] * len(person_ids)
+
+        if self.refine_distance is not None:
+            for i in np.flatnonzero(distances < self.refine_distance):
+                known_people.update(person_ids[i], features_matrix[i])
+
+        unmatched = np.flatnonzero(distances >= self.min_distance)
+
+        for group in self._group_faces(features_matrix[unmatched]):
+            person_id = str(uuid.uuid4())
+
+            # only the first face of each group introduces the new person
+            is_new_person[unmatched[group[0]]] = True
+
+            for i in group:
+                person_ids[unmatched[i]] = person_id
+
+        return person_ids, is_new_person
+
+    def _group_faces(self, features_matrix):
+        """Group the rows that are connected by distances below min_distance, returning the
+        sorted row indices of each group"""
+        labels = FaceClusterer(self.min_distance).cluster(features_matrix)
+
+        groups = {}
+
+        for i, label in enumerate(labels.tolist()):
+            groups.setdefault(label, []).append(i)
+
+        return list(groups.values())
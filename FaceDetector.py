@@ -1,6 +1,7 @@
 import bz2
 import os
 import tempfile
+import time
 import urllib.request
 
 import cv2
@@ -9,14 +10,41 @@ import numpy as np
 
 from Face import Face
 from HiddenPrints import HiddenPrints
-from face_detector.inference_usbCam_face import TensoflowFaceDector
+import metrics
+from face_detector.detector_backend import create_backend
 
 
 class FaceDetector:
-    def __init__(self, face_threshold=0.5, require_frontal_face=False):
+    def __init__(self, face_threshold=0.5, require_frontal_face=False, backend='tensorflow', roi_padding=0.25, max_roi_fraction=0.6, nms_threshold=None,
+                 detection_scale=0.5, interpolation=cv2.INTER_AREA, resolution_policy=None, frontal_score_threshold=0.9):
         self.face_threshold       = face_threshold
         self.require_frontal_face = require_frontal_face
 
+        # faces the detector scores at least frontal_score_threshold skip the frontal face
+        # detector when require_frontal_face is set, their box is aligned directly
+        self.frontal_score_threshold = frontal_score_threshold
+
+        # seconds spent in each frontal face stage during the last call, and in total
+        self.stage_times       = {}
+        self.total_stage_times = {}
+
+        # frames are resized by detection_scale before detection to detect faces more quickly.
+        # with a ResolutionPolicy, the scale is chosen per camera instead. either way a frame is
+        # never shrunk below the detector input, which would only be scaled back up after
+        self.detection_scale   = detection_scale
+        self.interpolation     = interpolation
+        self.resolution_policy = resolution_policy
+
+        # boxes overlapping a more confident box by more than nms_threshold iou are removed.
+        # None keeps every box the detector returns
+        self.nms_threshold = nms_threshold
+
+        # when detecting in regions of interest, each region is padded by roi_padding of its
+        # size and overlapping regions are merged. the frame is searched through a single crop
+        # when one region is left that covers at most max_roi_fraction of it, and whole otherwise
+        self.roi_padding      = roi_padding
+        self.max_roi_fraction = max_roi_fraction
+
         if self.require_frontal_face:
             shape_predictor_model_file = 'shape_predictor_5_face_landmarks.dat'
 
@@ -38,75 +66,352 @@ class FaceDetector:
             self.frontal_face_detector = dlib.get_frontal_face_detector()
             self.shape_predictor       = dlib.shape_predictor(shape_predictor_model_file)
 
-        self.detector = TensoflowFaceDector()
+        # the runtime used to run the face detection model, see face_detector.detector_backend.BACKENDS
+        self.detector = create_backend(backend)
+
+    def find_faces(self, frame, regions=None, camera_name=None):
+        """Find all faces in the given frame. If (x, y, width, height) regions are given,
+        only those parts of the frame are searched"""
+        boxes, scores = self.find_boxes(frame, regions, camera_name)
+
+        return self.crop_faces(frame, boxes, scores)
+
+    def find_faces_batch(self, frames, regions=None, camera_names=None):
+        """Find all faces in each of the given frames using a single detector run. regions
+        optionally holds the list of regions to search for each frame"""
+        detections = self.find_boxes_batch(frames, regions, camera_names)
+
+        return self.crop_faces_batch(frames, [boxes for boxes, scores in detections], [scores for boxes, scores in detections])
+
+    def find_boxes(self, frame, regions=None, camera_name=None):
+        """Find the (y1, x1, y2, x2) pixel boxes and scores of all faces in the given frame"""
+        return self.find_boxes_batch([frame], None if regions is None else [regions], [camera_name])[0]
+
+    def find_boxes_batch(self, frames, regions=None, camera_names=None):
+        """Find the pixel boxes and scores of all faces in each of the given frames using a
+        single detector run. camera_names lets the resolution policy pick a scale per camera"""
+        if regions is None:
+            regions = [None] * len(frames)
+
+        if camera_names is None:
+            camera_names = [None] * len(frames)
+
+        input_width, input_height = self.detector.input_size
+
+        # each frame is either searched whole, or as a set of crops around its regions
+        images  = []
+        sources = []
 
-    def find_faces(self, frame):
-        """Find all faces in the given frame"""
-        faces = []
+        for i, (frame, frame_regions, camera_name) in enumerate(zip(frames, regions, camera_names)):
+            scale = self.detection_scale
 
-        # we resize the frame to detect faces more quickly
-        resized_frame = cv2.resize(frame, (0, 0), fx=1.0 / 2.0, fy=1.0 / 2.0, interpolation=cv2.INTER_CUBIC)
+            if self.resolution_policy is not None and camera_name is not None:
+                scale = self.resolution_policy.get_scale(camera_name)
+
+            for roi in self._get_rois(frame, frame_regions):
+                x1, y1, x2, y2 = roi
+
+                image = frame[y1:y2, x1:x2, :]
+
+                # we resize the crops to detect faces more quickly, down to the detector input at most
+                image_scale = max(scale, min(1.0, max(input_width / (x2 - x1), input_height / (y2 - y1))))
+
+                if image_scale != 1.0:
+                    image = cv2.resize(image, (0, 0), fx=image_scale, fy=image_scale, interpolation=self.interpolation)
+
+                images.append(image)
+                sources.append((i, roi))
 
         with HiddenPrints():
-            boxes, scores, classes, num_detections = self.detector.run(resized_frame)
+            detections = self._detect(images)
+
+        frame_boxes  = [[] for _ in frames]
+        frame_scores = [[] for _ in frames]
+
+        for (i, roi), (boxes, scores) in zip(sources, detections):
+            # the normalized boxes of an image span the whole detector input, which is where
+            # the policy measures faces
+            if self.resolution_policy is not None and camera_names[i] is not None:
+                confident = boxes[scores > self.face_threshold]
+
+                self.resolution_policy.update(camera_names[i], np.minimum((confident[:, 2] - confident[:, 0]) * input_height, (confident[:, 3] - confident[:, 1]) * input_width))
+
+            frame_boxes[i].append(self._roi_to_frame(boxes, roi, frames[i].shape))
+            frame_scores[i].append(scores)
+
+        return [self._get_boxes(frame, np.concatenate(boxes), np.concatenate(scores)) for frame, boxes, scores in zip(frames, frame_boxes, frame_scores)]
+
+    def _get_rois(self, frame, regions):
+        """Pad and merge the regions into the (x1, y1, x2, y2) crop of the frame to search.
+
+        The graph stretches every input to 300x300, so a crop costs the detector exactly as much
+        as the whole frame. What a crop buys is resolution: the moving part of the frame fills
+        the input, so small faces in it keep more pixels. Each crop is a full detector pass, so
+        frames with more than one disjoint region are searched whole rather than paying a pass
+        per region"""
+        frame_height, frame_width = frame.shape[:2]
+
+        whole_frame = [(0, 0, frame_width, frame_height)]
+
+        if not regions:
+            return whole_frame
+
+        rois = []
+
+        for x, y, width, height in regions:
+            x_pad = int(self.roi_padding * width)
+            y_pad = int(self.roi_padding * height)
+
+            rois.append([max(x - x_pad, 0), max(y - y_pad, 0), min(x + width + x_pad, frame_width), min(y + height + y_pad, frame_height)])
+
+        # keep merging overlapping regions until every region is disjoint
+        merged = True
+
+        while merged:
+            merged = False
+
+            for i in range(len(rois)):
+                for j in range(i + 1, len(rois)):
+                    a, b = rois[i], rois[j]
+
+                    if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                        rois[i] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+
+                        del rois[j]
+
+                        merged = True
+                        break
+
+                if merged:
+                    break
+
+        rois = [roi for roi in rois if roi[2] > roi[0] and roi[3] > roi[1]]
+
+        if len(rois) != 1:
+            return whole_frame
+
+        x1, y1, x2, y2 = rois[0]
+
+        if (x2 - x1) * (y2 - y1) > self.max_roi_fraction * frame_width * frame_height:
+            return whole_frame
+
+        return [tuple(rois[0])]
+
+    @staticmethod
+    def _roi_to_frame(boxes, roi, frame_shape):
+        """Map normalized boxes of a crop to normalized boxes of the whole frame"""
+        x1, y1, x2, y2 = roi
+
+        frame_height, frame_width = frame_shape[:2]
+
+        offset = np.array([y1 / frame_height, x1 / frame_width] * 2)
+        scale  = np.array([(y2 - y1) / frame_height, (x2 - x1) / frame_width] * 2)
+
+        return boxes * scale + offset
+
+    def _detect(self, images):
+        """Run the detector over all images at once, returning the normalized (boxes, scores) of each image"""
+        # the graph stretches every image to its fixed input size anyway, so resizing them to it
+        # here lets images of any size share a run. boxes are normalized, so they stay relative
+        # to each image and come out the same whatever else is in the batch
+        input_width, input_height = self.detector.input_size
+
+        batch = np.stack([cv2.resize(image, (input_width, input_height), interpolation=self.interpolation) for image in images])
+
+        boxes, scores, classes, num_detections = self.detector.run_batch(batch)
+
+        return [(boxes[i], scores[i]) for i in range(len(images))]
+
+    def _get_boxes(self, frame, boxes, scores):
+        """Keep the confident normalized detector boxes, scaled to pixel boxes of the frame"""
+        frame_height, frame_width = frame.shape[:2]
+
+        frame_size = np.array([frame_height, frame_width] * 2)
 
         # get all boxes with confidence scores > face_threshold
-        boxes = boxes[scores > self.face_threshold]
+        confident = scores > self.face_threshold
+
+        # scale the boxes to match the resolution of the original frame, then clip them to it
+        boxes  = np.clip(boxes[confident] * frame_size, 0, frame_size)
+        scores = scores[confident]
+
+        # drop boxes that were clipped away entirely
+        valid = (boxes[:, 2] > boxes[:, 0]) & (boxes[:, 3] > boxes[:, 1])
+
+        boxes  = boxes[valid]
+        scores = scores[valid]
+
+        if self.nms_threshold is not None:
+            keep = self._non_max_suppression(boxes, scores, self.nms_threshold)
+
+            boxes  = boxes[keep]
+            scores = scores[keep]
+
+        return boxes, scores
+
+    @staticmethod
+    def _non_max_suppression(boxes, scores, iou_threshold):
+        """Returns the indices of the boxes kept by greedy non max suppression"""
+        areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+        order = np.argsort(-scores)
+        keep  = []
+
+        while len(order) > 0:
+            best  = order[0]
+            order = order[1:]
+
+            keep.append(best)
+
+            # iou of the best remaining box with every other remaining box
+            y1 = np.maximum(boxes[best, 0], boxes[order, 0])
+            x1 = np.maximum(boxes[best, 1], boxes[order, 1])
+            y2 = np.minimum(boxes[best, 2], boxes[order, 2])
+            x2 = np.minimum(boxes[best, 3], boxes[order, 3])
+
+            intersection = np.maximum(y2 - y1, 0) * np.maximum(x2 - x1, 0)
+            iou          = intersection / (areas[best] + areas[order] - intersection)
+
+            order = order[iou <= iou_threshold]
+
+        return np.array(keep, dtype=np.int64)
+
+    def crop_faces(self, frame, boxes, scores=None):
+        """Crop the faces out of the frame given their (y1, x1, y2, x2) pixel boxes and
+        optionally their detector scores"""
+        return self.crop_faces_batch([frame], [boxes], [scores])[0]
+
+    def crop_faces_batch(self, frames, boxes_per_frame, scores_per_frame=None):
+        """Crop the faces out of each of the given frames"""
+        if scores_per_frame is None:
+            scores_per_frame = [None] * len(frames)
+
+        crops_per_frame = [self._get_crop_boxes(frame, boxes, scores) for frame, boxes, scores in zip(frames, boxes_per_frame, scores_per_frame)]
+
+        if self.require_frontal_face:
+            return self._align_faces_batch(frames, crops_per_frame)
+
+        faces_per_frame = []
+
+        for frame, (boxes, crop_boxes, scores) in zip(frames, crops_per_frame):
+            faces = []
+
+            for y, x, y_max, x_max in crop_boxes.tolist():
+                # get the crop of the face. it is copied since the frame buffer is reused
+                crop = frame[y:y_max, x:x_max, :].copy()
+
+                # package up the face and associated metadata
+                face = Face(x, y, x_max - x, y_max - y, crop)
+
+                faces.append(face)
+
+            faces_per_frame.append(faces)
 
+        return faces_per_frame
+
+    def _get_crop_boxes(self, frame, boxes, scores):
+        """Pad the pixel boxes into crop boxes clipped to the frame. Returns the (boxes, crop_boxes, scores)
+        of every crop that is not empty"""
         frame_height, frame_width = frame.shape[:2]
 
-        for box in boxes:
-            # scale each box to match the resolution of the original frame
-            box[0] *= frame_height
-            box[1] *= frame_width
-            box[2] *= frame_height
-            box[3] *= frame_width
+        frame_size = np.array([frame_height, frame_width] * 2)
+
+        boxes = np.asarray(boxes).reshape(-1, 4).astype(int)
+
+        # boxes without a detector score never skip the frontal face detector
+        if scores is None:
+            scores = np.zeros(len(boxes))
+
+        scores = np.asarray(scores).reshape(-1)
+
+        pad_multiplier = 1 if self.require_frontal_face else 0.25
+
+        # pad every crop by a multiple of its (height, width), then clip the crops to the frame
+        padding = (pad_multiplier * (boxes[:, 2:] - boxes[:, :2])).astype(int)
+
+        crop_boxes = np.concatenate([boxes[:, :2] - padding, boxes[:, 2:] + padding], axis=1)
+        crop_boxes = np.clip(crop_boxes, 0, frame_size)
 
-            box = box.astype(np.int)
+        # drop crops that would be empty
+        valid = (crop_boxes[:, 2] > crop_boxes[:, 0]) & (crop_boxes[:, 3] > crop_boxes[:, 1])
 
-            y, x, y_max, x_max = box
+        return boxes[valid], crop_boxes[valid], scores[valid]
 
-            width  = x_max - x
-            height = y_max - y
+    def _align_faces_batch(self, frames, crops_per_frame):
+        """Find and align a frontal face in each crop. Every stage runs over all frames before
+        the next one starts, so the cost of each stage is measured on its own"""
+        stage_times = {}
 
-            pad_multiplier = 1 if self.require_frontal_face else 0.25
+        # find a frontal face rectangle, in frame coordinates, for each crop
+        start_time = time.time()
 
-            # pad the crop
-            x_pad = int(pad_multiplier * width)
-            y_pad = int(pad_multiplier * height)
+        rects_per_frame = []
 
-            x      -= x_pad
-            y      -= y_pad
-            width  += 2 * x_pad
-            height += 2 * y_pad
+        for frame, (boxes, crop_boxes, scores) in zip(frames, crops_per_frame):
+            rects = []
 
-            # get the crop of the face
-            crop = frame[y:y_max+y_pad, x:x_max+x_pad, :]
+            for box, crop_box, score in zip(boxes.tolist(), crop_boxes.tolist(), scores.tolist()):
+                if score >= self.frontal_score_threshold:
+                    y1, x1, y2, x2 = box
+
+                    rects.append(dlib.rectangle(x1, y1, x2, y2))
+
+                    continue
+
+                y, x, y_max, x_max = crop_box
 
-            if self.require_frontal_face:
                 # find a frontal face in this crop
-                frontal_faces = self.frontal_face_detector(crop, 0)
+                frontal_faces = self.frontal_face_detector(frame[y:y_max, x:x_max, :], 0)
 
                 if len(frontal_faces) > 0:
                     frontal_face = frontal_faces[0]
 
-                    # align this face in the crop
-                    shape = self.shape_predictor(crop, frontal_face)
-                    crop  = dlib.get_face_chip(crop, shape, size=150, padding=0.25)
+                    rects.append(dlib.rectangle(x + frontal_face.left(), y + frontal_face.top(), x + frontal_face.right(), y + frontal_face.bottom()))
+
+            rects_per_frame.append(rects)
+
+        stage_times['frontal_detection'] = time.time() - start_time
+
+        # find the landmarks of every face
+        start_time = time.time()
+
+        shapes_per_frame = []
 
-                    x      = x + frontal_face.left()
-                    y      = y + frontal_face.top()
-                    width  = frontal_face.right()  - frontal_face.left()
-                    height = frontal_face.bottom() - frontal_face.top()
+        for frame, rects in zip(frames, rects_per_frame):
+            shapes = dlib.full_object_detections()
 
+            for rect in rects:
+                shapes.append(self.shape_predictor(frame, rect))
+
+            shapes_per_frame.append(shapes)
+
+        stage_times['landmarks'] = time.time() - start_time
+
+        # align all faces of a frame with a single call
+        start_time = time.time()
+
+        faces_per_frame = []
+
+        for frame, rects, shapes in zip(frames, rects_per_frame, shapes_per_frame):
+            faces = []
+
+            if len(rects) > 0:
+                chips = dlib.get_face_chips(frame, shapes, size=150, padding=0.25)
+
+                for rect, chip in zip(rects, chips):
                     # package up the face and associated metadata
-                    face = Face(x, y, width, height, crop)
+                    face = Face(rect.left(), rect.top(), rect.right() - rect.left(), rect.bottom() - rect.top(), chip)
 
                     faces.append(face)
-            else:
-                # package up the face and associated metadata
-                face = Face(x, y, width, height, crop)
 
-                faces.append(face)
+            faces_per_frame.append(faces)
+
+        stage_times['alignment'] = time.time() - start_time
+
+        self.stage_times = stage_times
+
+        for stage, stage_time in stage_times.items():
+            self.total_stage_times[stage] = self.total_stage_times.get(stage, 0.0) + stage_time
+
+            metrics.observe('frontal_stage_seconds', stage_time, stage=stage)
 
-        return faces
+        return faces_per_frame
@@ -9,7 +9,11 @@ import numpy as np
 
 
 class FaceFeatureGenerator:
-    def __init__(self):
+    def __init__(self, num_jitters=5):
+        # each face is passed through the network num_jitters times with small random
+        # distortions and the descriptors are averaged
+        self.num_jitters = num_jitters
+
         generator_model_file = 'dlib_face_recognition_resnet_model_v1.dat'
 
         if not os.path.isfile(generator_model_file):
@@ -29,9 +33,24 @@ class FaceFeatureGenerator:
 
         self.generator = dlib.face_recognition_model_v1(generator_model_file)
 
-    def generate_features(self, face):
+    def generate_features(self, face, num_jitters=None):
+        if num_jitters is None:
+            num_jitters = self.num_jitters
+
         face_crop = cv2.resize(face.crop, (150, 150))
 
-        features = self.generator.compute_face_descriptor(face_crop, num_jitters=5)
+        features = self.generator.compute_face_descriptor(face_crop, num_jitters=num_jitters)
 
         return np.asarray(features)
+
+    def generate_features_batch(self, faces):
+        """Generate the features of all faces with a single call to the network. Returns an
+        (N, 128) float32 array with a row per face"""
+        if len(faces) == 0:
+            return np.zeros((0, 128), dtype=np.float32)
+
+        face_crops = [cv2.resize(face.crop, (150, 150)) for face in faces]
+
+        features = self.generator.compute_face_descriptor(face_crops, num_jitters=self.num_jitters)
+
+        return np.array([np.asarray(face_features) for face_features in features], dtype=np.float32)
@@ -0,0 +1,147 @@
+from collections import defaultdict, deque
+import queue
+import threading
+import time
+
+import metrics
+
+
+class FairFrameQueue:
+    def __init__(self, maxsize=32, max_age_ms=2000):
+        # frames are queued per camera and taken from the cameras in turn, so one busy camera
+        # cannot starve the others. all cameras together hold at most maxsize frames. when the
+        # queue is full a live frame takes the place of the oldest frame of the live camera
+        # with the most frames queued, and live frames older than max_age_ms are dropped
+        # instead of being processed. historical frames are never dropped, putting them blocks
+        # until there is room
+        self.maxsize    = maxsize
+        self.max_age_ms = max_age_ms
+
+        self.dropped_frames = defaultdict(int)
+
+        self._frames    = defaultdict(deque)
+        self._cameras   = deque()
+        self._size      = 0
+        self._sentinels = 0
+        self._condition = threading.Condition()
+
+    def put(self, item, block=True, timeout=None):
+        with self._condition:
+            if item is None:
+                self._sentinels += 1
+            else:
+                # items are either frames or (frame, face) tuples
+                frame_metadata = item[0] if isinstance(item, tuple) else item
+                camera_name    = frame_metadata.camera_name
+
+                frames = self._frames[camera_name]
+
+                if self._size >= self.maxsize:
+                    if frame_metadata.is_live:
+                        # with only historical frames queued the live frame goes over the limit
+                        # by one, as historical frames are never dropped
+                        self._drop_oldest_live_frame()
+                    elif not self._condition.wait_for(lambda: self._size < self.maxsize, timeout if block else 0):
+                        raise queue.Full
+
+                if camera_name not in self._cameras:
+                    self._cameras.append(camera_name)
+
+                frames.append(item)
+
+                self._size += 1
+
+            self._condition.notify_all()
+
+    def get(self, block=True, timeout=None):
+        """Take the oldest frame of the next camera in turn. None is only returned once every
+        frame put before it has been taken"""
+        deadline = None
+
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+
+        with self._condition:
+            while True:
+                item = self._next_item()
+
+                if item is not None:
+                    self._condition.notify_all()
+
+                    return item
+
+                if len(self._cameras) == 0 and self._sentinels > 0:
+                    self._sentinels -= 1
+
+                    return None
+
+                remaining = None
+
+                if not block:
+                    remaining = 0
+                elif deadline is not None:
+                    remaining = deadline - time.monotonic()
+
+                if remaining is not None and remaining <= 0:
+                    raise queue.Empty
+
+                self._condition.wait(remaining)
+
+    def qsize(self):
+        with self._condition:
+            return self._size
+
+    def _next_item(self):
+        while len(self._cameras) > 0:
+            camera_name = self._cameras.popleft()
+            frames      = self._frames[camera_name]
+
+            item = frames.popleft()
+
+            self._size -= 1
+
+            # the camera goes to the back of the line if it has more frames
+            if len(frames) > 0:
+                self._cameras.append(camera_name)
+
+            frame_metadata = item[0] if isinstance(item, tuple) else item
+
+            if frame_metadata.is_live and time.time() * 1000 - frame_metadata.timestamp > self.max_age_ms:
+                self._drop(item, camera_name, 'stale')
+                continue
+
+            return item
+
+        return None
+
+    def _drop_oldest_live_frame(self):
+        # the frames of a camera are either all live or all historical
+        live_cameras = [camera_name for camera_name, frames in self._frames.items() if len(frames) > 0 and self._is_live(frames[0])]
+
+        if len(live_cameras) == 0:
+            return
+
+        camera_name = max(live_cameras, key=lambda camera_name: len(self._frames[camera_name]))
+        frames      = self._frames[camera_name]
+
+        self._drop(frames.popleft(), camera_name, 'full')
+
+        self._size -= 1
+
+        if len(frames) == 0:
+            self._cameras.remove(camera_name)
+
+    @staticmethod
+    def _is_live(item):
+        frame_metadata = item[0] if isinstance(item, tuple) else item
+
+        return frame_metadata.is_live
+
+    def _drop(self, item, camera_name, reason):
+        # a dropped frame is never detected, so its buffer can be reused right away
+        if not isinstance(item, tuple):
+            item.release_frame()
+
+        self.dropped_frames[camera_name] += 1
+
+        metrics.increment('frames_dropped_total', camera=camera_name, reason=reason)
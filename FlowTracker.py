@@ -0,0 +1,131 @@
+import cv2
+import numpy as np
+
+
+class FlowTracker:
+    def __init__(self, detection_interval=5, tracking_scale=0.5, max_points_per_face=20, min_points_per_face=4):
+        # the face detector is run on every detection_interval-th frame of a camera. in
+        # between, the face boxes are moved along with the optical flow of the points inside them
+        self.detection_interval  = detection_interval
+        self.tracking_scale      = tracking_scale
+        self.max_points_per_face = max_points_per_face
+        self.min_points_per_face = min_points_per_face
+
+        self.tracks = {}
+
+    def schedule(self, camera_name):
+        """Returns whether the next frame of the camera should go through the face detector"""
+        if camera_name not in self.tracks:
+            return True
+
+        track = self.tracks[camera_name]
+
+        track.frames_since_detection += 1
+
+        if track.lost or track.frames_since_detection >= self.detection_interval:
+            track.frames_since_detection = 0
+
+            return True
+
+        return False
+
+    def reset(self, camera_name, frame, boxes, scores):
+        """Start tracking the given (y1, x1, y2, x2) pixel boxes found by the face detector"""
+        track = self.tracks.get(camera_name)
+
+        if track is None:
+            track = _CameraTrack()
+
+            self.tracks[camera_name] = track
+
+        track.gray_frame = self._get_gray_frame(frame)
+        track.boxes      = np.array(boxes, dtype=np.float32).reshape(-1, 4)
+        track.scores     = np.array(scores, dtype=np.float32).reshape(-1)
+        track.lost       = False
+
+    def update(self, camera_name, frame):
+        """Move the boxes of the camera to the given frame. Returns the (boxes, scores) of the
+        tracked faces, or None if the tracks were lost and the face detector needs to run"""
+        track = self.tracks[camera_name]
+
+        gray_frame = self._get_gray_frame(frame)
+
+        if len(track.boxes) == 0:
+            track.gray_frame = gray_frame
+
+            return track.boxes, track.scores
+
+        # collect the corners inside each box so all faces are tracked with one optical flow call
+        points       = []
+        point_owners = []
+
+        for i, box in enumerate(track.boxes * self.tracking_scale):
+            y1, x1, y2, x2 = np.round(box).astype(np.int32)
+
+            face_gray_frame = track.gray_frame[max(y1, 0):y2, max(x1, 0):x2]
+
+            if face_gray_frame.size == 0:
+                track.lost = True
+
+                return None
+
+            face_points = cv2.goodFeaturesToTrack(face_gray_frame, self.max_points_per_face, 0.01, 3)
+
+            if face_points is None or len(face_points) < self.min_points_per_face:
+                track.lost = True
+
+                return None
+
+            points.append(face_points.reshape(-1, 2) + np.array([max(x1, 0), max(y1, 0)], dtype=np.float32))
+            point_owners.append(np.full(len(face_points), i))
+
+        points       = np.concatenate(points).reshape(-1, 1, 2)
+        point_owners = np.concatenate(point_owners)
+
+        moved_points, status, _ = cv2.calcOpticalFlowPyrLK(track.gray_frame, gray_frame, points, None, winSize=(15, 15), maxLevel=2)
+
+        status = status.reshape(-1) == 1
+        motion = (moved_points - points).reshape(-1, 2)
+
+        frame_height, frame_width = frame.shape[:2]
+
+        boxes = track.boxes.copy()
+
+        for i in range(len(boxes)):
+            face_motion = motion[status & (point_owners == i)]
+
+            if len(face_motion) < self.min_points_per_face:
+                track.lost = True
+
+                return None
+
+            # move the box by the median motion of its points, which ignores points on the background
+            dx, dy = np.median(face_motion, axis=0) / self.tracking_scale
+
+            boxes[i] += [dy, dx, dy, dx]
+
+            # a face leaving the frame is treated as a lost track so the detector can confirm it
+            if boxes[i, 2] <= 0 or boxes[i, 3] <= 0 or boxes[i, 0] >= frame_height or boxes[i, 1] >= frame_width:
+                track.lost = True
+
+                return None
+
+        track.gray_frame = gray_frame
+        track.boxes      = boxes
+
+        return track.boxes.copy(), track.scores.copy()
+
+    def _get_gray_frame(self, frame):
+        gray_frame = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+
+        return cv2.resize(gray_frame, (0, 0), fx=self.tracking_scale, fy=self.tracking_scale, interpolation=cv2.INTER_AREA)
+
+
+class _CameraTrack:
+    def __init__(self):
+        self.gray_frame = None
+        self.boxes      = None
+        self.scores     = None
+        self.lost       = False
+
+        self.frames_since_detection = 0
@@ -0,0 +1,24 @@
+from collections import deque
+
+
+class FrameBufferPool:
+    def __init__(self, max_buffers=8):
+        # frames of a camera are read into recycled arrays instead of a new array per frame.
+        # a buffer comes back to the pool when its frame is released, and at most max_buffers
+        # free buffers are kept. when every buffer is in use the capture allocates a new one,
+        # so reading never waits for the rest of the pipeline
+        self.max_buffers = max_buffers
+
+        # deque appends and pops are atomic, so buffers can be released from other threads
+        self._free_buffers = deque()
+
+    def acquire(self):
+        """Returns a free buffer, or None if there is none and the capture should allocate one"""
+        try:
+            return self._free_buffers.pop()
+        except IndexError:
+            return None
+
+    def release(self, buffer):
+        if buffer is not None and len(self._free_buffers) < self.max_buffers:
+            self._free_buffers.append(buffer)
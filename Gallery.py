@@ -0,0 +1,403 @@
+import numpy as np
+
+# person ids are stored as fixed width bytes so the ids can be memory mapped like the vectors
+PERSON_ID_DTYPE = 'S64'
+
+
+class Gallery:
+    def __init__(self, dimensions=128, initial_capacity=1024, index=None, max_templates=5, template_diversity=0.3, screen_k=8, max_centroid_count=100):
+        # the feature vectors of all known people are kept in one contiguous matrix so a face
+        # can be compared against everyone at once. the matrix doubles in size when it is
+        # full, which keeps adding a person amortized O(1). each row holds the running
+        # centroid of the faces matched to that person
+        self.dimensions = dimensions
+
+        self._vectors    = np.zeros((initial_capacity, dimensions), dtype=np.float32)
+        self._norms      = np.zeros(initial_capacity, dtype=np.float32)
+        self._counts     = np.ones(initial_capacity, dtype=np.int64)
+        self._entity_ids = np.zeros(initial_capacity, dtype=np.int64)
+        self._person_ids = np.zeros(initial_capacity, dtype=PERSON_ID_DTYPE)
+        self._rows       = {}
+        self._size       = 0
+
+        # besides its centroid, each person keeps up to max_templates faces that are at least
+        # template_diversity apart. a face is screened against the screen_k closest centroids,
+        # then compared with the templates of those people. the centroid averages at most
+        # max_centroid_count faces so it keeps following slow changes in appearance
+        self.max_templates      = max_templates
+        self.template_diversity = template_diversity
+        self.screen_k           = screen_k
+        self.max_centroid_count = max_centroid_count
+
+        self._templates        = np.zeros((initial_capacity, dimensions), dtype=np.float32)
+        self._template_norms   = np.zeros(initial_capacity, dtype=np.float32)
+        self._num_templates    = 0
+        self._free_templates   = []
+        self._person_templates = {}
+
+        # counts the changes to the templates and centroids, so callers can tell when they need saving
+        self.refinements = 0
+
+        # an optional approximate nearest neighbour index, such as an IVFIndex, that limits
+        # each search to a subset of the rows. the subset is still compared exactly
+        self.index = index
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, person_id):
+        return person_id in self._get_rows()
+
+    def __iter__(self):
+        return (person_id.decode() for person_id in self._person_ids[:self._size].tolist())
+
+    def __getitem__(self, person_id):
+        row = self._get_rows()[person_id]
+
+        return int(self._entity_ids[row]), self._vectors[row].copy()
+
+    def __setitem__(self, person_id, person):
+        entity_id, vector = person
+
+        self.add(person_id, entity_id, vector)
+
+    def __repr__(self):
+        return 'Gallery(%d people)' % self._size
+
+    def add(self, person_id, entity_id, vector):
+        """Add a person to the gallery, or replace them if they are already in it"""
+        rows = self._get_rows()
+        row  = rows.get(person_id)
+
+        if row is None:
+            if self._size == len(self._vectors):
+                self._grow()
+
+            row = self._size
+
+            rows[person_id] = row
+            self._size     += 1
+
+        vector = np.asarray(vector, dtype=np.float32).reshape(self.dimensions)
+
+        self._vectors[row]    = vector
+        self._norms[row]      = np.dot(vector, vector)
+        self._counts[row]     = 1
+        self._entity_ids[row] = entity_id
+        self._person_ids[row] = person_id.encode()
+
+        # a replaced person starts over from the new vector, and their template slots are reused
+        if row in self._person_templates:
+            self._free_templates.extend(self._person_templates.pop(row))
+
+            self.refinements += 1
+
+        self._update_index(row)
+
+    def set_entity_id(self, person_id, entity_id):
+        self._entity_ids[self._get_rows()[person_id]] = entity_id
+
+    def update(self, person_id, vector):
+        """Refine a person with a face confidently matched to them, moving their centroid
+        towards it and keeping it as a template if it is unlike their other templates"""
+        row    = self._get_rows()[person_id]
+        vector = np.asarray(vector, dtype=np.float32).reshape(self.dimensions)
+
+        # a person without templates has only ever been described by their row vector
+        templates = self._person_templates.get(row)
+
+        if templates is None:
+            templates = [self._add_template(self._vectors[row])]
+
+            self._person_templates[row] = templates
+
+        template_vectors   = self._templates[templates]
+        template_distances = np.sqrt(np.maximum(self._template_norms[templates] - 2 * np.dot(template_vectors, vector) + np.dot(vector, vector), 0))
+
+        if template_distances.min() > self.template_diversity:
+            if len(templates) < self.max_templates:
+                templates.append(self._add_template(vector))
+            else:
+                # evict the most redundant template, the one closest to another template or to the new face
+                candidates = np.concatenate([template_vectors, vector[np.newaxis, :]])
+                difference = template_vectors[:, np.newaxis, :] - candidates[np.newaxis, :, :]
+                distances  = np.sqrt(np.einsum('ijk,ijk->ij', difference, difference))
+
+                distances[np.arange(len(templates)), np.arange(len(templates))] = np.inf
+
+                slot = templates[int(np.argmin(distances.min(axis=1)))]
+
+                self._templates[slot]      = vector
+                self._template_norms[slot] = np.dot(vector, vector)
+
+        # move the running centroid towards the face
+        count = self._counts[row]
+
+        self._vectors[row] += (vector - self._vectors[row]) / (count + 1)
+        self._norms[row]    = np.dot(self._vectors[row], self._vectors[row])
+        self._counts[row]   = min(count + 1, self.max_centroid_count)
+
+        self.refinements += 1
+
+        self._update_index(row)
+
+    def load(self, person_ids, entity_ids, vectors, norms):
+        """Replace the contents of the gallery with the given arrays, which may be memory mapped.
+        They are only copied into memory once the gallery grows past them"""
+        self._vectors    = vectors
+        self._norms      = norms
+        self._counts     = np.ones(len(vectors), dtype=np.int64)
+        self._entity_ids = entity_ids
+        self._person_ids = person_ids
+        self._size       = len(vectors)
+
+        self._num_templates    = 0
+        self._free_templates   = []
+        self._person_templates = {}
+
+        # looking up a person by id needs a dict of every row, which is built on first use
+        self._rows = None
+
+        if self.index is not None and self.index.needs_training(self._size):
+            self.index.train_in_background(self._vectors[:self._size])
+
+    def get_templates(self):
+        """Returns the person id of every template and an array of the templates, for saving"""
+        person_ids = []
+        slots      = []
+
+        for row, templates in self._person_templates.items():
+            person_ids.extend([self._person_ids[row]] * len(templates))
+            slots.extend(templates)
+
+        return np.array(person_ids, dtype=PERSON_ID_DTYPE), self._templates[slots].copy()
+
+    def load_templates(self, person_ids, vectors):
+        """Replace the templates with ones returned by get_templates. Templates of people who
+        are not in the gallery are skipped"""
+        rows = self._get_rows()
+
+        self._num_templates    = 0
+        self._free_templates   = []
+        self._person_templates = {}
+
+        for person_id, vector in zip(person_ids.tolist(), vectors):
+            row = rows.get(person_id.decode())
+
+            if row is not None:
+                self._person_templates.setdefault(row, []).append(self._add_template(vector))
+
+    def get_centroids(self):
+        """Returns the person ids, centroids and face counts of every refined person, for saving"""
+        rows = np.flatnonzero(self._counts[:self._size] > 1)
+
+        return self._person_ids[rows].copy(), self._vectors[rows].copy(), self._counts[rows].copy()
+
+    def load_centroids(self, person_ids, vectors, counts):
+        """Restore centroids returned by get_centroids. Centroids of people who are not in the
+        gallery are skipped"""
+        rows = self._get_rows()
+
+        for person_id, vector, count in zip(person_ids.tolist(), vectors, counts.tolist()):
+            row = rows.get(person_id.decode())
+
+            if row is None:
+                continue
+
+            self._vectors[row] = vector
+            self._norms[row]   = np.dot(vector, vector)
+            self._counts[row]  = count
+
+            # the index files the row again, or notes it for a training that is running
+            if self.index is not None:
+                self.index.add(row, self._vectors[row])
+
+    def nearest(self, vector):
+        """Returns the id of the closest person to the vector and the distance to them, or
+        (None, infinity) if the gallery is empty"""
+        if self._size == 0:
+            return None, float('infinity')
+
+        vector = np.asarray(vector, dtype=np.float32).reshape(self.dimensions)
+
+        rows = None
+
+        if self.index is not None:
+            self.index.swap_in_training(self._vectors[:self._size])
+
+        if self.index is not None and self.index.is_trained:
+            rows = self.index.candidates(vector)
+
+            if len(rows) == 0:
+                return None, float('infinity')
+
+            # compare the candidates exactly
+            squared_distances = self._norms[rows] - 2 * np.dot(self._vectors[rows], vector) + np.dot(vector, vector)
+        else:
+            # |a - b|^2 = |a|^2 - 2ab + |b|^2, where the |a|^2 of every row is cached
+            squared_distances = self._norms[:self._size] - 2 * np.dot(self._vectors[:self._size], vector) + np.dot(vector, vector)
+
+        return self._match_templates(vector, rows, squared_distances)
+
+    def nearest_batch(self, vectors):
+        """Returns the ids of the closest people to each row of the vectors matrix and the
+        distances to them"""
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dimensions)
+
+        if self.index is not None:
+            self.index.swap_in_training(self._vectors[:self._size])
+
+        if self._size == 0 or (self.index is not None and self.index.is_trained):
+            nearest = [self.nearest(vector) for vector in vectors]
+
+            return [person_id for person_id, _ in nearest], np.array([distance for _, distance in nearest])
+
+        person_ids = []
+        distances  = np.empty(len(vectors))
+
+        # compare probes against the whole matrix in chunks that keep the distance matrices small
+        chunk_size = max(1, min(256, (1 << 22) // self._size))
+
+        for start in range(0, len(vectors), chunk_size):
+            chunk       = vectors[start:start + chunk_size]
+            chunk_norms = np.einsum('ij,ij->i', chunk, chunk)
+
+            squared_distances = self._norms[np.newaxis, :self._size] - 2 * np.dot(chunk, self._vectors[:self._size].T) + chunk_norms[:, np.newaxis]
+
+            # without templates the centroids are the only vectors there are
+            if len(self._person_templates) == 0:
+                best_rows      = np.argmin(squared_distances, axis=1)
+                best_distances = squared_distances[np.arange(len(chunk)), best_rows]
+            else:
+                best_rows, best_distances = self._match_templates_batch(chunk, chunk_norms, squared_distances)
+
+            person_ids.extend(person_id.decode() for person_id in self._person_ids[best_rows].tolist())
+            distances[start:start + len(chunk)] = np.sqrt(np.maximum(best_distances, 0))
+
+        return person_ids, distances
+
+    def _match_templates_batch(self, chunk, chunk_norms, squared_distances):
+        """The batch version of _match_templates over every row. Every probe is screened against
+        its screen_k closest centroids, and the templates of all the screened people are compared
+        with the whole chunk in one product"""
+        num_screened = min(self.screen_k, self._size)
+
+        if self._size > num_screened:
+            screened = np.argpartition(squared_distances, num_screened - 1, axis=1)[:, :num_screened]
+        else:
+            screened = np.tile(np.arange(self._size), (len(chunk), 1))
+
+        screened_distances = np.take_along_axis(squared_distances, screened, axis=1)
+
+        # screened people with templates are compared with their closest template instead
+        template_rows = np.array([row for row in np.unique(screened).tolist() if row in self._person_templates], dtype=np.int64)
+
+        if len(template_rows) > 0:
+            slots  = [self._person_templates[row] for row in template_rows.tolist()]
+            starts = np.cumsum([0] + [len(templates) for templates in slots[:-1]])
+            slots  = np.concatenate(slots)
+
+            template_distances = self._template_norms[np.newaxis, slots] - 2 * np.dot(chunk, self._templates[slots].T) + chunk_norms[:, np.newaxis]
+            closest_templates  = np.minimum.reduceat(template_distances, starts, axis=1)
+
+            positions     = np.minimum(np.searchsorted(template_rows, screened), len(template_rows) - 1)
+            has_templates = template_rows[positions] == screened
+
+            screened_distances = np.where(has_templates, np.take_along_axis(closest_templates, positions, axis=1), screened_distances)
+
+        best = np.argmin(screened_distances, axis=1)
+
+        return screened[np.arange(len(chunk)), best], screened_distances[np.arange(len(chunk)), best]
+
+    def _match_templates(self, vector, rows, squared_distances):
+        """Given the squared centroid distances of the candidate rows (every row if rows is None),
+        compare the vector with the templates of the closest centroids and return the closest
+        person and the distance to their closest template"""
+        if rows is None:
+            rows = np.arange(len(squared_distances))
+
+        # without templates the centroids are the only vectors there are
+        if len(self._person_templates) == 0:
+            best = int(np.argmin(squared_distances))
+
+            return self._person_ids[rows[best]].decode(), float(np.sqrt(max(squared_distances[best], 0)))
+
+        screened = np.arange(len(squared_distances))
+
+        if len(screened) > self.screen_k:
+            screened = np.argpartition(squared_distances, self.screen_k)[:self.screen_k]
+
+        best_row      = None
+        best_distance = np.inf
+
+        for i in screened:
+            row = rows[i]
+
+            templates = self._person_templates.get(row)
+
+            if templates is None:
+                distance = squared_distances[i]
+            else:
+                distance = np.min(self._template_norms[templates] - 2 * np.dot(self._templates[templates], vector) + np.dot(vector, vector))
+
+            if distance < best_distance:
+                best_row      = row
+                best_distance = distance
+
+        return self._person_ids[best_row].decode(), float(np.sqrt(max(best_distance, 0)))
+
+    def _add_template(self, vector):
+        if len(self._free_templates) == 0 and self._num_templates == len(self._templates):
+            capacity = max(2 * len(self._templates), 1024)
+
+            self._templates      = self._resize(self._templates,      capacity)
+            self._template_norms = self._resize(self._template_norms, capacity)
+
+        # slots freed by replaced people are reused first
+        if len(self._free_templates) > 0:
+            slot = self._free_templates.pop()
+        else:
+            slot = self._num_templates
+
+            self._num_templates += 1
+
+        self._templates[slot]      = vector
+        self._template_norms[slot] = np.dot(vector, vector)
+
+        return slot
+
+    def _update_index(self, row):
+        if self.index is None:
+            return
+
+        # training runs in the background so adding people never waits for k-means. until it
+        # is swapped in, searches use the previous training, or compare every row before the first
+        self.index.swap_in_training(self._vectors[:self._size])
+
+        self.index.add(row, self._vectors[row])
+
+        if self.index.needs_training(self._size):
+            self.index.train_in_background(self._vectors[:self._size])
+
+    def _get_rows(self):
+        if self._rows is None:
+            self._rows = {person_id.decode(): row for row, person_id in enumerate(self._person_ids[:self._size].tolist())}
+
+        return self._rows
+
+    def _grow(self):
+        capacity = max(2 * len(self._vectors), 1024)
+
+        self._vectors    = self._resize(self._vectors,    capacity)
+        self._norms      = self._resize(self._norms,      capacity)
+        self._counts     = self._resize(self._counts,     capacity)
+        self._entity_ids = self._resize(self._entity_ids, capacity)
+        self._person_ids = self._resize(self._person_ids, capacity)
+
+    @staticmethod
+    def _resize(array, capacity):
+        resized = np.empty((capacity,) + array.shape[1:], dtype=array.dtype)
+
+        resized[:len(array)] = array
+
+        return resized
@@ -0,0 +1,177 @@
+import json
+import os
+
+import numpy as np
+
+from Gallery import PERSON_ID_DTYPE
+
+
+class GallerySnapshot:
+    def __init__(self, directory, dimensions=128, read_only=False):
+        # a gallery is saved as fixed stride, append only files with a row per person, so it
+        # can be memory mapped on start instead of being downloaded and unpickled. other
+        # processes can open it read_only to follow the people appended by its writer
+        self.directory  = directory
+        self.dimensions = dimensions
+        self.read_only  = read_only
+
+        if not read_only:
+            os.makedirs(directory, exist_ok=True)
+
+        self._files = {
+            'person_ids': (os.path.join(directory, 'person_ids.bin'), np.dtype(PERSON_ID_DTYPE), ()),
+            'entity_ids': (os.path.join(directory, 'entity_ids.bin'), np.dtype(np.int64),       ()),
+            'vectors':    (os.path.join(directory, 'vectors.bin'),    np.dtype(np.float32),     (dimensions,)),
+            'norms':      (os.path.join(directory, 'norms.bin'),      np.dtype(np.float32),     ())
+        }
+
+        self._meta_file = os.path.join(directory, 'meta.json')
+
+        # the rows keep the vector each person was first seen with. their refined centroids,
+        # face counts and templates keep changing, so rather than being appended they are
+        # rewritten as a whole by save_refinements
+        self._refinements_file = os.path.join(directory, 'refinements.npz')
+
+        # a crash between appends can leave some files a row ahead of the others. cut them
+        # back to the last complete row so new rows line up again. readers leave that to the
+        # writer, as the row could still be being written
+        if read_only:
+            return
+
+        count = len(self)
+
+        for path, dtype, shape in self._files.values():
+            if os.path.isfile(path):
+                with open(path, 'r+b') as f:
+                    f.truncate(count * self._row_size(dtype, shape))
+
+    @property
+    def synced_until(self):
+        """The updated_at time of the newest person synced from the people table"""
+        if not os.path.isfile(self._meta_file):
+            return 0
+
+        with open(self._meta_file) as f:
+            return json.load(f)['synced_until']
+
+    @synced_until.setter
+    def synced_until(self, timestamp):
+        # write a new file and rename it over the old one so the meta file is never half written
+        temp_file = self._meta_file + '.tmp'
+
+        with open(temp_file, 'w') as f:
+            json.dump({'synced_until': int(timestamp), 'dimensions': self.dimensions}, f)
+
+        os.replace(temp_file, self._meta_file)
+
+    def __len__(self):
+        # only rows written to every file count
+        counts = []
+
+        for path, dtype, shape in self._files.values():
+            counts.append(os.path.getsize(path) // self._row_size(dtype, shape) if os.path.isfile(path) else 0)
+
+        return min(counts)
+
+    def load(self, gallery):
+        """Memory map the snapshot into the gallery. Returns the number of people loaded"""
+        count = len(self)
+
+        if count == 0:
+            return 0
+
+        # copy on write maps keep changes made by the gallery in memory only
+        arrays = {name: np.memmap(path, dtype=dtype, mode='c', shape=(count,) + shape) for name, (path, dtype, shape) in self._files.items()}
+
+        gallery.load(arrays['person_ids'], arrays['entity_ids'], arrays['vectors'], arrays['norms'])
+
+        self.load_refinements(gallery)
+
+        return count
+
+    def load_new(self, gallery):
+        """Add the people appended since the gallery was loaded from the snapshot, without reloading
+        the others. Returns the number of people added"""
+        start = len(gallery)
+        count = len(self)
+
+        if count <= start:
+            return 0
+
+        arrays = {}
+
+        for name, (path, dtype, shape) in self._files.items():
+            row_size = self._row_size(dtype, shape)
+
+            arrays[name] = np.fromfile(path, dtype=dtype, count=(count - start) * row_size // dtype.itemsize, offset=start * row_size).reshape((count - start,) + shape)
+
+        for person_id, entity_id, vector in zip(arrays['person_ids'].tolist(), arrays['entity_ids'].tolist(), arrays['vectors']):
+            gallery.add(person_id.decode(), entity_id, vector)
+
+        return count - start
+
+    @property
+    def refinements_mtime(self):
+        """When the refinements were last saved, or None if they never were"""
+        if not os.path.isfile(self._refinements_file):
+            return None
+
+        return os.path.getmtime(self._refinements_file)
+
+    def load_refinements(self, gallery):
+        """Restore the saved centroids, face counts and templates into the gallery, if there are any"""
+        if os.path.isfile(self._refinements_file):
+            with np.load(self._refinements_file) as refinements:
+                gallery.load_centroids(refinements['centroid_person_ids'], refinements['centroids'], refinements['counts'])
+                gallery.load_templates(refinements['template_person_ids'], refinements['templates'])
+
+    def save_refinements(self, gallery):
+        """Replace the saved refinements with the current centroids, face counts and templates of the gallery"""
+        centroid_person_ids, centroids, counts = gallery.get_centroids()
+        template_person_ids, templates         = gallery.get_templates()
+
+        # write a new file and rename it over the old one so the refinements are never half written
+        temp_file = self._refinements_file + '.tmp'
+
+        with open(temp_file, 'wb') as f:
+            np.savez(f, centroid_person_ids=centroid_person_ids, centroids=centroids, counts=counts, template_person_ids=template_person_ids, templates=templates)
+
+        os.replace(temp_file, self._refinements_file)
+
+    def append(self, person_id, entity_id, vector):
+        """Append a person to the end of the snapshot"""
+        vector = np.asarray(vector, dtype=np.float32).reshape(self.dimensions)
+
+        rows = {
+            'person_ids': np.array([person_id.encode()], dtype=PERSON_ID_DTYPE),
+            'entity_ids': np.array([entity_id],          dtype=np.int64),
+            'vectors':    vector.reshape(1, -1),
+            'norms':      np.array([np.dot(vector, vector)], dtype=np.float32)
+        }
+
+        for name, (path, dtype, shape) in self._files.items():
+            with open(path, 'ab') as f:
+                f.write(rows[name].tobytes())
+
+    def set_entity_id(self, person_id, entity_id):
+        """Rewrite the entity id of a person in place"""
+        path, dtype, shape = self._files['person_ids']
+
+        person_ids = np.memmap(path, dtype=dtype, mode='r', shape=(len(self),))
+        rows       = np.flatnonzero(person_ids == person_id.encode())
+
+        del person_ids
+
+        if len(rows) == 0:
+            return
+
+        # rows have a fixed stride, so the entity id of a row is at a known offset
+        path, dtype, shape = self._files['entity_ids']
+
+        with open(path, 'r+b') as f:
+            f.seek(int(rows[0]) * self._row_size(dtype, shape))
+            f.write(np.array([entity_id], dtype=dtype).tobytes())
+
+    @staticmethod
+    def _row_size(dtype, shape):
+        return dtype.itemsize * int(np.prod(shape, dtype=np.int64))
@@ -0,0 +1,230 @@
+import threading
+
+import numpy as np
+
+
+class IVFIndex:
+    def __init__(self, num_lists=None, num_probes=8, min_train_size=10000, max_train_points=65536, iterations=10, retrain_factor=2, seed=0):
+        # an inverted file index: the vectors are clustered with k-means and every gallery row
+        # is filed under its closest centroid. a search only looks at the rows filed under the
+        # num_probes centroids closest to the query, so raising num_probes trades speed for recall.
+        # num_lists defaults to 2 * sqrt(gallery size) when the index is trained. the candidate
+        # rows are then compared exactly, so the ranking of whatever the probes find is exact
+        self.num_lists        = num_lists
+        self.num_probes       = num_probes
+        self.min_train_size   = min_train_size
+        self.max_train_points = max_train_points
+        self.iterations       = iterations
+        self.retrain_factor   = retrain_factor
+
+        self._rng = np.random.default_rng(seed)
+
+        self.centroids    = None
+        self.trained_size = 0
+
+        self._centroid_norms = None
+        self._list_rows      = []
+        self._list_sizes     = None
+        self._row_lists      = np.zeros(0, dtype=np.int64)
+
+        # a training running in the background, the lists it produced once it is done, and the
+        # rows that were added or moved while it ran
+        self._training_thread = None
+        self._pending         = None
+        self._changed_rows    = None
+
+    @property
+    def is_trained(self):
+        return self.centroids is not None
+
+    @property
+    def is_training(self):
+        return self._training_thread is not None
+
+    def needs_training(self, size):
+        """Returns whether the index should be (re)trained for a gallery of the given size"""
+        if self.is_training:
+            return False
+
+        if not self.is_trained:
+            return size >= self.min_train_size
+
+        return size >= self.retrain_factor * self.trained_size
+
+    def train(self, vectors):
+        """Cluster the vectors and file every one of them, replacing any previous training"""
+        self._install(self._fit(vectors))
+
+    def train_in_background(self, vectors):
+        """Cluster the vectors in a thread. Searches keep using the current training, or none,
+        until swap_in_training is called once the thread is done"""
+        self._changed_rows = set()
+
+        self._training_thread        = threading.Thread(target=self._background_fit, args=(vectors,))
+        self._training_thread.daemon = True
+        self._training_thread.start()
+
+    def swap_in_training(self, vectors):
+        """Start using a finished background training. vectors are the current gallery rows, the
+        rows added or moved while the training ran are filed again from them"""
+        if self._training_thread is None or self._training_thread.is_alive():
+            return
+
+        self._training_thread.join()
+
+        state, changed_rows = self._pending, self._changed_rows
+
+        self._training_thread = None
+        self._pending         = None
+        self._changed_rows    = None
+
+        # a failed training leaves the current one in place, and is retried on the next add
+        if state is None:
+            return
+
+        self._install(state)
+
+        changed_rows.update(range(self.trained_size, len(vectors)))
+
+        for row in sorted(changed_rows):
+            self.add(row, vectors[row])
+
+    def _background_fit(self, vectors):
+        # numpy releases the gil in the matrix products, so training runs alongside matching
+        try:
+            self._pending = self._fit(vectors)
+        except Exception as e:
+            print('Training the gallery index failed: %s' % e)
+
+    def _fit(self, vectors):
+        num_lists = self.num_lists
+
+        if num_lists is None:
+            num_lists = int(2 * np.sqrt(len(vectors)))
+
+        num_lists = max(1, min(num_lists, len(vectors)))
+
+        # k-means on a sample of the vectors is plenty to place the centroids
+        sample = vectors
+
+        if len(vectors) > self.max_train_points:
+            sample = vectors[self._rng.choice(len(vectors), self.max_train_points, replace=False)]
+
+        centroids = sample[self._rng.choice(len(sample), num_lists, replace=False)].astype(np.float32)
+
+        for _ in range(self.iterations):
+            assignments = self._assign(sample, centroids)
+
+            # sum the vectors of each cluster in one pass over the sample sorted by cluster
+            order    = np.argsort(assignments, kind='stable')
+            clusters = assignments[order]
+            starts   = np.flatnonzero(np.r_[True, clusters[1:] != clusters[:-1]])
+
+            sums   = np.add.reduceat(sample[order], starts, axis=0)
+            counts = np.diff(np.r_[starts, len(clusters)])
+
+            # clusters that lost all their vectors keep their old centroid
+            centroids[clusters[starts]] = sums / counts[:, np.newaxis]
+
+        # file every vector under its closest centroid. rows that are not filed map to list -1
+        row_lists  = np.full(max(len(vectors), 1), -1, dtype=np.int64)
+        list_rows  = [np.zeros(0, dtype=np.int64) for _ in range(num_lists)]
+        list_sizes = np.zeros(num_lists, dtype=np.int64)
+
+        assignments = self._assign(vectors, centroids)
+
+        order    = np.argsort(assignments, kind='stable')
+        clusters = assignments[order]
+        starts   = np.flatnonzero(np.r_[True, clusters[1:] != clusters[:-1]])
+        ends     = np.r_[starts[1:], len(clusters)]
+
+        for start, end in zip(starts, ends):
+            list_id = clusters[start]
+
+            list_rows[list_id]  = order[start:end].astype(np.int64)
+            list_sizes[list_id] = end - start
+
+        row_lists[:len(vectors)] = assignments
+
+        return centroids, len(vectors), row_lists, list_rows, list_sizes
+
+    def _install(self, state):
+        centroids, trained_size, row_lists, list_rows, list_sizes = state
+
+        self.centroids       = centroids
+        self._centroid_norms = np.einsum('ij,ij->i', centroids, centroids)
+        self.trained_size    = trained_size
+        self._row_lists      = row_lists
+        self._list_rows      = list_rows
+        self._list_sizes     = list_sizes
+
+    def add(self, row, vector):
+        """File a new gallery row, or move an existing row whose vector changed"""
+        if self._changed_rows is not None:
+            self._changed_rows.add(row)
+
+        if not self.is_trained:
+            return
+
+        if row >= len(self._row_lists):
+            capacity = max(row + 1, 2 * len(self._row_lists))
+
+            self._row_lists = np.concatenate([self._row_lists, np.full(capacity - len(self._row_lists), -1, dtype=np.int64)])
+
+        if self._row_lists[row] >= 0:
+            self._remove(row)
+
+        list_id = int(np.argmin(self._centroid_norms - 2 * np.dot(self.centroids, vector)))
+
+        rows = self._list_rows[list_id]
+        size = self._list_sizes[list_id]
+
+        if size == len(rows):
+            rows = np.concatenate([rows, np.zeros(max(size, 8), dtype=np.int64)])
+
+            self._list_rows[list_id] = rows
+
+        rows[size]                 = row
+        self._list_sizes[list_id] += 1
+        self._row_lists[row]       = list_id
+
+    def candidates(self, vector):
+        """Returns the gallery rows filed under the centroids closest to the vector"""
+        squared_distances = self._centroid_norms - 2 * np.dot(self.centroids, vector)
+
+        num_probes = min(self.num_probes, len(self.centroids))
+
+        probes = np.argpartition(squared_distances, num_probes - 1)[:num_probes]
+
+        return np.concatenate([self._list_rows[list_id][:self._list_sizes[list_id]] for list_id in probes])
+
+    def _remove(self, row):
+        list_id = self._row_lists[row]
+
+        rows = self._list_rows[list_id]
+        size = self._list_sizes[list_id]
+
+        position = np.flatnonzero(rows[:size] == row)
+
+        if len(position) == 0:
+            return
+
+        # move the last row of the list into the freed position
+        rows[position[0]]          = rows[size - 1]
+        self._list_sizes[list_id] -= 1
+        self._row_lists[row]       = -1
+
+    @staticmethod
+    def _assign(vectors, centroids, chunk_size=65536):
+        """Returns the index of the closest centroid to each vector"""
+        centroid_norms = np.einsum('ij,ij->i', centroids, centroids)
+
+        assignments = np.empty(len(vectors), dtype=np.int64)
+
+        # |v - c|^2 = |v|^2 - 2vc + |c|^2, and |v|^2 does not change which centroid is closest
+        for start in range(0, len(vectors), chunk_size):
+            chunk = vectors[start:start + chunk_size]
+
+            assignments[start:start + chunk_size] = np.argmin(centroid_norms - 2 * np.dot(chunk, centroids.T), axis=1)
+
+        return assignments
@@ -5,20 +5,36 @@ import numpy as np
 
 
 class MovementDetector:
-    def __init__(self):
+    def __init__(self, time_of_last_movement=None, width=384):
+        # time_of_last_movement can be shared with the VideoStreamer, which samples cameras
+        # that have not moved in a while less often
+        if time_of_last_movement is None:
+            time_of_last_movement = defaultdict(int)
+
         self.background_images     = {}
         self.kernel                = np.ones((3, 3), np.uint8)
-        self.time_of_last_movement = defaultdict(int)
+        self.time_of_last_movement = time_of_last_movement
+
+        # frames are compared at this width, a fifth of a 1080p frame, whatever size the
+        # stream delivers, so the minimum movement area means the same at every resolution
+        self.width = width
 
     def detect_movement(self, frame_metadata):
-        # return True
+        movement_detected, _ = self.detect_movement_regions(frame_metadata)
+
+        return movement_detected
+
+    def detect_movement_regions(self, frame_metadata):
+        """Returns whether there is movement in the frame, along with the (x, y, width, height)
+        boxes of the moving regions in frame coordinates"""
+        # return True, []
         frame       = frame_metadata.frame
         timestamp   = frame_metadata.timestamp
         camera_name = frame_metadata.camera_name
 
         # get smaller, gray version of frame
         gray_frame = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
-        gray_frame = cv2.resize(gray_frame, (0, 0), fx=1.0 / 5.0, fy=1.0 / 5.0, interpolation=cv2.INTER_NEAREST)
+        gray_frame = cv2.resize(gray_frame, (self.width, max(1, round(frame.shape[0] * self.width / frame.shape[1]))), interpolation=cv2.INTER_NEAREST)
         gray_frame = gray_frame.astype(np.float64)
 
         # if this is the first frame from this camera, save it in memory
@@ -39,6 +55,11 @@ class MovementDetector:
         contours, _ = cv2.findContours(diff_frame.astype(np.uint8), cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
 
         movement_detected = False
+        movement_regions  = []
+
+        # scale from the small difference image back to the original frame
+        x_scale = frame.shape[1] / gray_frame.shape[1]
+        y_scale = frame.shape[0] / gray_frame.shape[0]
 
         # look for large areas of the difference image
         for contour in contours:
@@ -48,7 +69,9 @@ class MovementDetector:
                 movement_detected                       = True
                 self.time_of_last_movement[camera_name] = timestamp
 
-                break
+                x, y, width, height = cv2.boundingRect(contour)
+
+                movement_regions.append((int(x * x_scale), int(y * y_scale), int(width * x_scale), int(height * y_scale)))
 
         if not movement_detected:
             if (timestamp - self.time_of_last_movement[camera_name]) < 5000:
@@ -57,4 +80,4 @@ class MovementDetector:
         # update background image
         cv2.accumulateWeighted(gray_frame, self.background_images[camera_name], 0.1)
 
-        return movement_detected
+        return movement_detected, movement_regions
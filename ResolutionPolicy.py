@@ -0,0 +1,38 @@
+from collections import defaultdict, deque
+
+import numpy as np
+
+
+class ResolutionPolicy:
+    def __init__(self, min_face_size=20, default_scale=0.5, min_scale=0.0, max_scale=1.0, history_size=500, min_samples=20):
+        # the detector stretches every image to its fixed input size, so the scale does not
+        # change what detection costs. it decides how far a frame is shrunk on the host before
+        # that last resize, and the FaceDetector never lets it shrink a side below the input.
+        # face sizes are measured as the network sees them, at the input size. cameras whose
+        # small faces reach the network with at least min_face_size pixels are shrunk as far as
+        # min_scale and the input allow, the others are passed at max_scale so the last resize
+        # works from every pixel of the frame
+        self.min_face_size = min_face_size
+        self.default_scale = default_scale
+        self.min_scale     = min_scale
+        self.max_scale     = max_scale
+        self.min_samples   = min_samples
+
+        self.face_sizes = defaultdict(lambda: deque(maxlen=history_size))
+
+    def get_scale(self, camera_name):
+        """Get the scale the next frame of the camera should be resized by before detection"""
+        face_sizes = self.face_sizes[camera_name]
+
+        if len(face_sizes) < self.min_samples:
+            return self.default_scale
+
+        # the smallest faces this camera sees decide whether its frames can be shrunk
+        if np.percentile(face_sizes, 5) < self.min_face_size:
+            return self.max_scale
+
+        return self.min_scale
+
+    def update(self, camera_name, face_sizes):
+        """Record the sizes, in pixels of the detector input, of the faces detected on the camera"""
+        self.face_sizes[camera_name].extend(np.asarray(face_sizes).reshape(-1).tolist())
@@ -0,0 +1,120 @@
+import multiprocessing
+from multiprocessing import shared_memory
+import os
+
+import numpy as np
+
+
+class SharedFaceBuffer:
+    def __init__(self, num_slots=128, max_crop_size=(320, 320), dimensions=128):
+        # face crops and feature vectors are kept in fixed slots of one shared memory block, so
+        # only the slot number travels through the queues between processes. a slot is taken
+        # when a face is stored and has to be released once the face has been matched. crops
+        # larger than max_crop_size (height, width) do not fit a slot and travel with the face
+        self.num_slots     = num_slots
+        self.max_crop_size = max_crop_size
+        self.dimensions    = dimensions
+
+        crops_size    = num_slots * max_crop_size[0] * max_crop_size[1] * 3
+        features_size = num_slots * dimensions * np.dtype(np.float32).itemsize
+
+        self._shared_memory = shared_memory.SharedMemory(create=True, size=crops_size + features_size)
+
+        # forked workers inherit this object as it is, so the creating process is told apart by
+        # its pid rather than by a flag every copy would share
+        self._owner_pid = os.getpid()
+
+        # the free slots are shared between processes. taking a slot blocks while all of them
+        # are in use, which holds back the producer until the consumers catch up
+        self._free_slots = multiprocessing.Queue()
+
+        for slot in range(num_slots):
+            self._free_slots.put(slot)
+
+        self._map_arrays()
+
+    def __getstate__(self):
+        # other processes attach to the shared memory block by name
+        state = self.__dict__.copy()
+
+        state['_shared_memory'] = self._shared_memory.name
+
+        del state['_crops']
+        del state['_features']
+
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+        self._shared_memory = shared_memory.SharedMemory(name=state['_shared_memory'])
+
+        self._map_arrays()
+
+    def _map_arrays(self):
+        crops_shape = (self.num_slots, self.max_crop_size[0], self.max_crop_size[1], 3)
+        crops_size  = int(np.prod(crops_shape))
+
+        self._crops    = np.ndarray(crops_shape, dtype=np.uint8, buffer=self._shared_memory.buf)
+        self._features = np.ndarray((self.num_slots, self.dimensions), dtype=np.float32, buffer=self._shared_memory.buf, offset=crops_size)
+
+    def store_crop(self, face):
+        """Move the crop of the face into a free slot"""
+        height, width = face.crop.shape[:2]
+
+        if height > self.max_crop_size[0] or width > self.max_crop_size[1]:
+            return
+
+        slot = self._free_slots.get(block=True)
+
+        self._crops[slot, :height, :width] = face.crop
+
+        face.slot       = slot
+        face.crop_shape = (height, width)
+        face.crop       = None
+
+    def load_crop(self, face):
+        """Returns the crop of the face. The crop is a view of the slot, so it has to be copied
+        if it is needed after the slot is released"""
+        if face.slot is None:
+            return face.crop
+
+        height, width = face.crop_shape
+
+        return self._crops[face.slot, :height, :width]
+
+    def store_features(self, face):
+        """Move the features of the face into its slot"""
+        if face.slot is None:
+            return
+
+        self._features[face.slot] = face.features
+        face.features             = None
+
+    def load_features(self, face):
+        if face.slot is None:
+            return face.features
+
+        return self._features[face.slot].copy()
+
+    def release(self, face):
+        """Give the slot of the face back so it can be reused"""
+        if face.slot is None:
+            return
+
+        self._free_slots.put(face.slot)
+
+        face.slot = None
+
+    def close(self):
+        # the views have to be dropped before the block can be closed
+        self._crops    = None
+        self._features = None
+
+        self._shared_memory.close()
+
+        # the process that created the block removes it, once
+        if os.getpid() == self._owner_pid:
+            self._shared_memory.unlink()
+
+            self._owner_pid = None
@@ -0,0 +1,54 @@
+import multiprocessing
+import queue
+import zlib
+
+
+class StageQueue:
+    def __init__(self, num_producers=1, num_consumers=1, maxsize=32, multiprocess=False, ordered_by_camera=False, queue_type=None):
+        # the queue between two pipeline stages that may each have a pool of workers. a
+        # producer puts None when it is finished, and once every producer has done so each
+        # consumer is sent its own None. with ordered_by_camera, every consumer reads its own
+        # queue and the items of a camera always go to the same consumer, so they stay in order.
+        # queue_type can replace the queue class, and is called with the maxsize
+        if queue_type is None:
+            queue_type = multiprocessing.Queue if multiprocess else queue.Queue
+
+        num_queues = num_consumers if ordered_by_camera else 1
+
+        self.num_consumers = num_consumers
+        self.queues        = [queue_type(maxsize=maxsize) for _ in range(num_queues)]
+
+        self._producers_left = multiprocessing.Value('i', num_producers)
+
+    def put(self, item, block=True, timeout=None):
+        if item is None:
+            self._finish_producer()
+            return
+
+        self._get_queue(item).put(item, block=block, timeout=timeout)
+
+    def get_queue(self, consumer):
+        """Returns the queue the given consumer should read from"""
+        return self.queues[consumer % len(self.queues)]
+
+    def qsize(self):
+        return sum(q.qsize() for q in self.queues)
+
+    def _get_queue(self, item):
+        if len(self.queues) == 1:
+            return self.queues[0]
+
+        # items are either frames or (frame, face) tuples
+        camera_name = item[0].camera_name if isinstance(item, tuple) else item.camera_name
+
+        return self.queues[zlib.crc32(camera_name.encode()) % len(self.queues)]
+
+    def _finish_producer(self):
+        with self._producers_left.get_lock():
+            self._producers_left.value -= 1
+
+            is_last_producer = self._producers_left.value == 0
+
+        if is_last_producer:
+            for consumer in range(self.num_consumers):
+                self.get_queue(consumer).put(None)
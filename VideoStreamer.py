@@ -1,13 +1,22 @@
 import datetime
 import os
+import random
 import threading
+import time
 import traceback
 
 import cv2
 
+from FrameBufferPool import FrameBufferPool
+import metrics
+import tracing
+
+# ways historical files can be sampled, see VideoStreamer
+HISTORICAL_SAMPLING_MODES = ('frames', 'stride', 'seek')
+
 
 class VideoStreamer:
-    def __init__(self, output_queue, frame_interval=3, max_streams=10, debug_logs=True):
+    def __init__(self, output_queue, frame_interval=3, max_streams=10, debug_logs=True, idle_frame_interval=None, idle_after_ms=30000, time_of_last_movement=None, output_width=None, output_fps=None, full_resolution_crops=False, frame_buffers=8, min_reconnect_delay=1, max_reconnect_delay=300, stats_interval=None, historical_sampling='frames', historical_sample_ms=100):
         # we process every frame_interval frames to save processing time.
         # most adjacent frames are near identical, so processing every
         # frame is often redundant
@@ -16,7 +25,55 @@ class VideoStreamer:
         self.max_streams    = max_streams
         self.debug_logs     = debug_logs
 
+        # with an idle_frame_interval, a camera that has not moved for idle_after_ms is only
+        # sampled every idle_frame_interval frames. time_of_last_movement is shared with the
+        # MovementDetector, which records the timestamp of the last movement of each camera
+        self.idle_frame_interval   = idle_frame_interval
+        self.idle_after_ms         = idle_after_ms
+        self.time_of_last_movement = time_of_last_movement
+
+        # with an output_width and output_fps, gstreamer scales the frames down to that width
+        # and drops frames down to that rate while they are still in the decoder's format, so
+        # full size frames are never converted to BGR. opencv reads a single appsink, so with
+        # full_resolution_crops the pipeline keeps the full resolution and the frame is scaled
+        # down once here, keeping the full resolution frame to crop the faces from
+        self.output_width          = output_width
+        self.output_fps            = output_fps
+        self.full_resolution_crops = full_resolution_crops
+
+        # the number of recycled frame buffers kept per camera, see FrameBufferPool
+        self.frame_buffers = frame_buffers
+
+        # a live stream that fails is reconnected after a random delay of up to min_reconnect_delay
+        # seconds, and the limit doubles with every failure in a row up to max_reconnect_delay
+        self.min_reconnect_delay = min_reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+
+        # files are sampled by historical_sampling:
+        #   'frames' takes every frame_interval-th frame, like live streams
+        #   'stride' takes the first frame every historical_sample_ms of video, grabbing the rest
+        #   'seek'   seeks historical_sample_ms ahead after every frame, so only the frames from
+        #            the keyframe before each sample are decoded
+        if historical_sampling not in HISTORICAL_SAMPLING_MODES:
+            raise ValueError('Unknown historical sampling "%s", expected one of %s' % (historical_sampling, ', '.join(HISTORICAL_SAMPLING_MODES)))
+
+        self.historical_sampling  = historical_sampling
+        self.historical_sample_ms = historical_sample_ms
+
         self.stream_threads = []
+        self.stream_stats   = {}
+
+        # a thread slot is taken by each threaded file and given back when the file ends. live
+        # streams never end on their own, so they do not take slots and always get a thread
+        self._stream_slots = threading.BoundedSemaphore(max_streams)
+        self._stop_event   = threading.Event()
+
+        # with a stats_interval, the uptime, frame rate and decode errors of every camera are
+        # reported every stats_interval seconds
+        if stats_interval is not None:
+            stats_thread        = threading.Thread(target=self._stats_worker, args=(stats_interval,))
+            stats_thread.daemon = True
+            stats_thread.start()
 
     def start_stream(self, camera_name, camera_stream, start_time, delete_file, threaded):
         """Start processing a stream"""
@@ -28,24 +85,65 @@ class VideoStreamer:
             auto_restart = True
             is_live      = True
 
-            camera_stream = 'rtspsrc location="%s" latency=0 drop-on-latency=true ! queue2 max-size-buffers=2 ! decodebin ! videoconvert ! appsink' % camera_stream
+            camera_stream = self._build_pipeline('rtspsrc location="%s" latency=0 drop-on-latency=true' % camera_stream)
         else:
             if delete_file:
                 file_to_delete = camera_stream
 
-            camera_stream = 'filesrc location="%s" ! queue2 max-size-buffers=2 ! decodebin ! videoconvert ! appsink' % camera_stream
+            camera_stream = self._build_pipeline('filesrc location="%s"' % camera_stream)
 
         if threaded:
-            if len(self.stream_threads) == self.max_streams:
-                self.stream_threads[0].join()
+            # wait for any file to finish if every slot is taken
+            if not is_live:
+                self._stream_slots.acquire()
 
-            stream_thread = threading.Thread(target=self._process_stream, args=(camera_name, camera_stream, is_live, start_time, file_to_delete, auto_restart))
+            self.stream_threads = [stream_thread for stream_thread in self.stream_threads if stream_thread.is_alive()]
+
+            stream_thread = threading.Thread(target=self._run_stream_thread, args=(camera_name, camera_stream, is_live, start_time, file_to_delete, auto_restart))
             stream_thread.start()
 
             self.stream_threads.append(stream_thread)
         else:
             self._process_stream(camera_name, camera_stream, is_live, start_time, file_to_delete, auto_restart)
 
+    def _build_pipeline(self, source):
+        """Build the gstreamer pipeline that decodes the source into BGR frames for the appsink"""
+        elements = [source, 'queue2 max-size-buffers=2', 'decodebin']
+
+        if self.output_fps is not None:
+            elements += ['videorate drop-only=true', 'video/x-raw,framerate=%d/1' % self.output_fps]
+
+        if self.output_width is not None and not self.full_resolution_crops:
+            elements += ['videoscale', 'video/x-raw,width=%d,pixel-aspect-ratio=1/1' % self.output_width]
+
+        elements += ['videoconvert', 'video/x-raw,format=BGR', 'appsink']
+
+        return ' ! '.join(elements)
+
+    def stop(self):
+        """Stop reading every stream and stop reconnecting them. Frames already read are still processed"""
+        self._stop_event.set()
+
+    @property
+    def is_stopped(self):
+        return self._stop_event.is_set()
+
+    def report_stream_stats(self):
+        """Print the uptime, frame rate and decode errors of every camera"""
+        for camera_name, stats in list(self.stream_stats.items()):
+            fps = stats.get_fps()
+
+            print('Camera %s: %s, up %.1f%% of %.1fh, %.1f fps, %d decode errors, %d reconnects' % (
+                camera_name, 'connected' if stats.is_connected else 'disconnected', 100 * stats.get_uptime(), stats.get_age() / 3600, fps, stats.decode_errors, stats.reconnects))
+
+            metrics.set_gauge('stream_connected',    int(stats.is_connected), camera=camera_name)
+            metrics.set_gauge('stream_uptime_ratio', stats.get_uptime(),      camera=camera_name)
+            metrics.set_gauge('stream_fps',          fps,                     camera=camera_name)
+
+    def _stats_worker(self, stats_interval):
+        while not self._stop_event.wait(stats_interval):
+            self.report_stream_stats()
+
     def join(self):
         """Block until all streams are finished"""
         while True:
@@ -62,54 +160,298 @@ class VideoStreamer:
             else:
                 break
 
+    def _run_stream_thread(self, camera_name, camera_stream, is_live, start_time, file_to_delete, auto_restart):
+        try:
+            self._process_stream(camera_name, camera_stream, is_live, start_time, file_to_delete, auto_restart)
+        finally:
+            if not is_live:
+                self._stream_slots.release()
+
     def _process_stream(self, camera_name, camera_stream, is_live, start_time, file_to_delete, auto_restart):
+        """Read the stream until it ends. With auto_restart, the stream is reconnected whenever it
+        ends, backing off exponentially with jitter while it keeps failing"""
+        stats = StreamStats()
+
+        self.stream_stats[camera_name] = stats
+
+        frame_pool = FrameBufferPool(self.frame_buffers)
+        backoff    = self.min_reconnect_delay
+
+        try:
+            while True:
+                self._read_stream(camera_name, camera_stream, is_live, start_time, frame_pool, stats)
+
+                if not auto_restart or self._stop_event.is_set():
+                    break
+
+                # a stream that delivered frames for a while is not failing in a row anymore. one
+                # that connects but delivers nothing, or stalls soon after, keeps backing off
+                if stats.get_streaming_time() >= self.max_reconnect_delay:
+                    backoff = self.min_reconnect_delay
+
+                # a random delay keeps cameras that failed together, such as after a network
+                # outage, from all reconnecting at the same moment
+                delay = random.uniform(0, backoff)
+
+                print('Stream %s ended, reconnecting in %.1fs' % (camera_name, delay))
+
+                stats.reconnects += 1
+
+                metrics.increment('stream_reconnects_total', camera=camera_name)
+
+                if self._stop_event.wait(delay):
+                    break
+
+                backoff = min(2 * backoff, self.max_reconnect_delay)
+        finally:
+            if file_to_delete is not None:
+                os.remove(file_to_delete)
+
+    def _read_stream(self, camera_name, camera_stream, is_live, start_time, frame_pool, stats):
+        """Read frames from the stream until it ends or fails"""
         video_capture = cv2.VideoCapture(camera_stream, cv2.CAP_GSTREAMER)
         # video_capture = cv2.VideoCapture("/home/crc/reward-faces/video2.mp4")
 
-        frame_index = 0
+        if not video_capture.isOpened():
+            print('Camera %s is not opened.' % camera_name)
+
+            self._record_decode_error(camera_name, stats)
+            return
+
+        stats.set_connected(True)
+
+        try:
+            if not is_live and self.historical_sampling == 'seek':
+                self._read_by_seeking(video_capture, camera_name, start_time, frame_pool, stats)
+            else:
+                self._read_sequentially(video_capture, camera_name, is_live, start_time, frame_pool, stats, stride=not is_live and self.historical_sampling == 'stride')
+        except Exception:
+            traceback.print_exc()
+
+            self._record_decode_error(camera_name, stats)
+        finally:
+            video_capture.release()
+
+            stats.set_connected(False)
+
+    def _read_sequentially(self, video_capture, camera_name, is_live, start_time, frame_pool, stats, stride=False, next_sample_ms=0):
+        """Grab every frame of the stream and retrieve the sampled ones. With stride, a frame is
+        sampled every historical_sample_ms of video from next_sample_ms on rather than by frame count"""
+        frame_index      = 0
+        next_frame_index = 0
 
         while True:
-            try:
-                if video_capture.isOpened():
-                    status, frame = video_capture.read()
-
-                    if status:
-                        if (frame_index % self.frame_interval) == 0:
-                            if start_time is None:
-                                timestamp = int(datetime.datetime.now(datetime.timezone.utc).timestamp() * 1000)
-                            else:
-                                timestamp = int(start_time + video_capture.get(cv2.CAP_PROP_POS_MSEC))
-
-                            frame_metadata = FrameMetadata()
-                            frame_metadata.frame       = frame#= cv2.cvtColor(frame, cv2.COLOR_YUV2RGB_NV12)
-                            frame_metadata.camera_name = camera_name
-                            frame_metadata.timestamp   = timestamp
-                            frame_metadata.is_live     = is_live
-
-                            if self.debug_logs:
-                                print('Queue size: %d' % self.output_queue.qsize())
-                                print('Processing camera %s' % frame_metadata.camera_name)
-                                print()
-
-                            self.output_queue.put(frame_metadata)
-
-                        frame_index += 1
-                    else:
-                        video_capture.release()
-                        break
-                else:
-                    print("Camera is not opened.")
+            read_start_time = time.monotonic()
+
+            if self._stop_event.is_set():
+                break
+
+            # skipped frames are only grabbed, so they are never copied out of the pipeline
+            status = video_capture.grab()
+
+            if not status:
+                # a file has ended, while a live stream has stopped delivering frames
+                if is_live:
+                    self._record_decode_error(camera_name, stats)
+
+                break
+
+            stats.record_frame()
+
+            if stride:
+                position_ms = video_capture.get(cv2.CAP_PROP_POS_MSEC)
+                is_sampled  = position_ms >= next_sample_ms
+
+                if is_sampled:
+                    next_sample_ms = position_ms + self.historical_sample_ms
+            else:
+                is_sampled = frame_index >= next_frame_index
+
+            if is_sampled:
+                timestamp = self._get_timestamp(video_capture, start_time)
+
+                if not stride:
+                    next_frame_index = frame_index + self._get_frame_interval(camera_name, timestamp)
+
+                if not self._output_frame(video_capture, camera_name, is_live, timestamp, frame_pool, stats, read_start_time):
                     break
-            except:
-                traceback.print_exc()
-                video_capture.release()
+
+            frame_index += 1
+
+    def _read_by_seeking(self, video_capture, camera_name, start_time, frame_pool, stats):
+        """Read a frame every historical_sample_ms of a file, seeking past the frames between"""
+        target_ms = 0
+
+        while True:
+            read_start_time = time.monotonic()
+
+            # the result of set() is not checked, since gstreamer pipelines report a seek as
+            # done even when they go on from where they were
+            if target_ms > 0:
+                video_capture.set(cv2.CAP_PROP_POS_MSEC, target_ms)
+
+            if self._stop_event.is_set() or not video_capture.grab():
                 break
 
-        if auto_restart:
-            self._process_stream(camera_name, camera_stream, is_live, start_time, file_to_delete, auto_restart)
+            stats.record_frame()
+
+            # the position of the frame that was grabbed, which can be past the target
+            position_ms = video_capture.get(cv2.CAP_PROP_POS_MSEC)
+
+            # a frame well short of the target means the seek did not happen. the rest of the
+            # file is then sampled by stride, which decodes every frame but keeps the same samples.
+            # the frame just grabbed comes before the target, so it would not have been sampled
+            if position_ms < target_ms - self.historical_sample_ms / 2:
+                print('Stream %s can not seek, sampling by stride from %dms' % (camera_name, target_ms))
+
+                self._read_sequentially(video_capture, camera_name, False, start_time, frame_pool, stats, stride=True, next_sample_ms=target_ms)
+                break
+
+            timestamp = self._get_timestamp(video_capture, start_time)
+
+            if not self._output_frame(video_capture, camera_name, False, timestamp, frame_pool, stats, read_start_time):
+                break
+
+            # never seek backwards, even if a seek lands past its target
+            target_ms = max(target_ms, position_ms) + self.historical_sample_ms
+
+    def _get_timestamp(self, video_capture, start_time):
+        """The timestamp, in milliseconds, of the frame that was just grabbed"""
+        if start_time is None:
+            return int(datetime.datetime.now(datetime.timezone.utc).timestamp() * 1000)
+
+        return int(start_time + video_capture.get(cv2.CAP_PROP_POS_MSEC))
+
+    def _output_frame(self, video_capture, camera_name, is_live, timestamp, frame_pool, stats, read_start_time):
+        """Retrieve the grabbed frame and send it down the pipeline. Returns False if it could
+        not be decoded"""
+        # decode into a recycled buffer. opencv allocates a new array instead
+        # if there is no free buffer or the buffer has the wrong shape
+        status, frame = video_capture.retrieve(frame_pool.acquire())
+
+        if not status:
+            self._record_decode_error(camera_name, stats)
+            return False
+
+        full_frame = None
+
+        if self.full_resolution_crops and self.output_width is not None and frame.shape[1] > self.output_width:
+            full_frame = frame
+            frame      = cv2.resize(frame, (self.output_width, round(frame.shape[0] * self.output_width / frame.shape[1])), interpolation=cv2.INTER_AREA)
+
+        frame_metadata = FrameMetadata()
+        frame_metadata.frame       = frame#= cv2.cvtColor(frame, cv2.COLOR_YUV2RGB_NV12)
+        frame_metadata.full_frame  = full_frame
+        frame_metadata.frame_pool  = frame_pool
+        frame_metadata.camera_name = camera_name
+        frame_metadata.timestamp   = timestamp
+        frame_metadata.is_live     = is_live
+
+        # wall clock time the frame was read, which latency is measured from
+        frame_metadata.capture_time = time.time()
+
+        metrics.increment('frames_captured_total', camera=camera_name)
+
+        frame_metadata.trace_id = tracing.start_trace()
+
+        tracing.record_span(frame_metadata, 'capture', read_start_time)
+
+        if self.debug_logs:
+            print('Queue size: %d' % self.output_queue.qsize())
+            print('Processing camera %s' % frame_metadata.camera_name)
+            print()
+
+        self.output_queue.put(frame_metadata)
+
+        return True
+
+    def _record_decode_error(self, camera_name, stats):
+        stats.decode_errors += 1
+
+        metrics.increment('stream_decode_errors_total', camera=camera_name)
 
-        if file_to_delete is not None:
-            os.remove(file_to_delete)
+    def _get_frame_interval(self, camera_name, timestamp):
+        """Sample cameras densely while they move and sparsely once they have been still for a while"""
+        if self.idle_frame_interval is None or self.time_of_last_movement is None:
+            return self.frame_interval
+
+        if (timestamp - self.time_of_last_movement.get(camera_name, 0)) < self.idle_after_ms:
+            return self.frame_interval
+
+        return self.idle_frame_interval
+
+
+class StreamStats:
+    def __init__(self):
+        # counts kept per camera by the VideoStreamer. times are time.monotonic() seconds
+        self.start_time      = time.monotonic()
+        self.connected_since = None
+        self.connected_time  = 0.0
+        self.frames_read     = 0
+        self.decode_errors   = 0
+        self.reconnects      = 0
+
+        # when the current or last connection delivered its first and latest frames
+        self.first_frame_time = None
+        self.last_frame_time  = None
+
+        # frames_read and the time when the frame rate was last measured
+        self._fps_frames = 0
+        self._fps_time   = self.start_time
+
+    @property
+    def is_connected(self):
+        return self.connected_since is not None
+
+    def set_connected(self, connected):
+        now = time.monotonic()
+
+        if connected:
+            self.connected_since  = now
+            self.first_frame_time = None
+            self.last_frame_time  = None
+        elif self.connected_since is not None:
+            self.connected_time  += now - self.connected_since
+            self.connected_since  = None
+
+    def record_frame(self):
+        now = time.monotonic()
+
+        if self.first_frame_time is None:
+            self.first_frame_time = now
+
+        self.last_frame_time  = now
+        self.frames_read     += 1
+
+    def get_streaming_time(self):
+        """How long the current or last connection has been delivering frames for"""
+        if self.first_frame_time is None:
+            return 0.0
+
+        return self.last_frame_time - self.first_frame_time
+
+    def get_age(self):
+        return time.monotonic() - self.start_time
+
+    def get_uptime(self):
+        """The fraction of the time since the stream was started that it has been connected"""
+        connected_time = self.connected_time
+
+        if self.connected_since is not None:
+            connected_time += time.monotonic() - self.connected_since
+
+        return connected_time / max(self.get_age(), 1e-6)
+
+    def get_fps(self):
+        """The rate frames were read at since the previous call"""
+        now = time.monotonic()
+
+        fps = (self.frames_read - self._fps_frames) / max(now - self._fps_time, 1e-6)
+
+        self._fps_frames = self.frames_read
+        self._fps_time   = now
+
+        return fps
 
 
 class FrameMetadata:
@@ -119,3 +461,30 @@ class FrameMetadata:
         self.timestamp   = timestamp
         self.is_live     = is_live
         self.faces       = []
+
+        # the full resolution frame faces are cropped from, when frame has been scaled down
+        self.full_frame = None
+
+        # the pool the frame buffer goes back to when the frame is released
+        self.frame_pool = None
+
+        # time.time() when the frame was read from the stream
+        self.capture_time = None
+
+        # the id of a frame sampled for tracing, or None, and the (start, end) time.monotonic()
+        # of each stage the frame has been through
+        self.trace_id    = None
+        self.stage_times = {}
+
+        # (x, y, width, height) boxes of the moving parts of the frame, set by the MovementDetector
+        self.motion_regions = None
+
+    def release_frame(self):
+        """Give the frame buffer back to its pool once nothing reads the frame anymore"""
+        if self.frame_pool is not None:
+            # the decoded buffer is the full resolution frame when the frame was scaled down
+            self.frame_pool.release(self.frame if self.full_frame is None else self.full_frame)
+
+        self.frame      = None
+        self.full_frame = None
+        self.frame_pool = None
@@ -3,13 +3,17 @@ import os
 import sys
 import tempfile
 import threading
+import time
 
 import boto3
+from boto3.dynamodb.conditions import Key
 from boto3.dynamodb.types import Binary
 import cv2
 from dotenv import load_dotenv
 import numpy as np
 
+import tracing
+
 # load aws credentials from .env file
 load_dotenv()
 
@@ -33,6 +37,17 @@ processed_videos_table = dynamodb.Table('processed_videos')
 
 s3 = aws_session.resource('s3')
 
+# people are stamped with the time they were last written to the people table, when they are
+# created and when an entity is assigned to them. a global secondary index on it, partitioned by
+# a constant, lets the people added or changed since a sync be queried in order without
+# scanning the table. its partition only sees a write per new or changed person
+UPDATED_AT_INDEX = 'updated_at-index'
+SYNC_PARTITION   = 0
+
+# clocks of different writers drift, and a write can land a little after it was stamped, so
+# every sync reads back this far before the last one. people read twice are skipped
+SYNC_OVERLAP_MS = 60000
+
 
 def get_known_people(known_people):
     # get_known_people_thread = threading.Thread(target=_get_known_people, args=(known_people,))
@@ -52,6 +67,49 @@ def _get_known_people(known_people):
     print(known_people)
 
 
+def get_people_updated_since(updated_at):
+    """Get the (id, entity_id, face_vector, updated_at) of every person written to the people table
+    after the given time in milliseconds, give or take SYNC_OVERLAP_MS. 0 reads the whole table"""
+    people = []
+
+    if updated_at == 0:
+        # people written before updated_at was stamped are not in the index, so the first
+        # sync scans the table once. they count as written when the scan started
+        read      = people_table.scan
+        kwargs    = {}
+        scan_time = _get_updated_at()
+    else:
+        read   = people_table.query
+        kwargs = {
+            'IndexName': UPDATED_AT_INDEX,
+            'KeyConditionExpression': Key('sync_partition').eq(SYNC_PARTITION) & Key('updated_at').gt(updated_at - SYNC_OVERLAP_MS)
+        }
+
+    while True:
+        response = read(**kwargs)
+
+        for person in response['Items']:
+            person_updated_at = int(person['updated_at']) if 'updated_at' in person else scan_time
+
+            people.append((person['id'], int(person['entity_id']), _bytes_to_numpy(person['face_vector'].value), person_updated_at))
+
+        if 'LastEvaluatedKey' not in response:
+            break
+
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    return people
+
+
+def set_person_entity(person_id, entity_id):
+    """Assign an entity to a person. Anything assigning entities has to stamp updated_at like
+    this, or gallery snapshots never see the change"""
+    people_table.update_item(
+        Key={'id': person_id},
+        UpdateExpression='SET entity_id = :entity_id, updated_at = :updated_at, sync_partition = :sync_partition',
+        ExpressionAttributeValues={':entity_id': entity_id, ':updated_at': _get_updated_at(), ':sync_partition': SYNC_PARTITION})
+
+
 def get_processed_videos():
     processed_videos = set()
 
@@ -74,13 +132,46 @@ def aws_update_worker(face_queue):
         if face is None:
             break
 
-        if not face.is_new_person:
-            save_face_to_faces_table(face)
+        start_time = time.monotonic()
+
+        # a list of faces is saved with one bulk write
+        if isinstance(face, list):
+            save_faces(face)
+
+            for saved_face in face:
+                tracing.record_span(saved_face, 'aws_update', start_time)
         else:
-            save_face_to_people_table(face)
+            if not face.is_new_person:
+                save_face_to_faces_table(face)
+            else:
+                save_face_to_people_table(face)
+
+            tracing.record_span(face, 'aws_update', start_time)
+
+
+def save_faces(faces):
+    """Save many faces at once using batched writes to the faces and people tables"""
+    with faces_table.batch_writer() as faces_writer, people_table.batch_writer() as people_writer:
+        for face in faces:
+            if not face.is_new_person:
+                faces_writer.put_item(Item=_get_faces_table_item(face, _upload_face_image(face)))
+            else:
+                people_writer.put_item(Item=_get_people_table_item(face))
 
 
 def save_face_to_faces_table(face):
+    s3_key = _upload_face_image(face)
+
+    # save item to dynamodb
+    faces_table.put_item(Item=_get_faces_table_item(face, s3_key))
+
+
+def save_face_to_people_table(face):
+    # save item to dynamodb
+    people_table.put_item(Item=_get_people_table_item(face))
+
+
+def _upload_face_image(face):
     # upload face image to s3
     image_file = os.path.join(tempfile.gettempdir(), '%s.png' % face.id)
     s3_key     = 'faces/%s.png' % face.id
@@ -89,31 +180,41 @@ def save_face_to_faces_table(face):
     s3.meta.client.upload_file(image_file, Bucket='228byers', Key=s3_key)
     os.remove(image_file)
 
+    return s3_key
+
+
+def _get_faces_table_item(face, s3_key):
     # convert numpy array to bytes
     feature_bytes = _numpy_to_bytes(face.features)
 
-    # save item to dynamodb
-    faces_table.put_item(Item={
+    return {
         'id': face.id,
         'location': face.location,
         'timestamp': face.timestamp,
         's3_key': s3_key,
         'face_vector': Binary(feature_bytes),
         'person_id': face.person_id
-    })
+    }
 
 
-def save_face_to_people_table(face):
+def _get_people_table_item(face):
     # convert numpy array to bytes
     feature_bytes = _numpy_to_bytes(face.features)
 
-    # save item to dynamodb
-    people_table.put_item(Item={
+    return {
         'id': face.person_id,
         'entity_id': -1,
         'first_seen': face.timestamp,
+        'updated_at': _get_updated_at(),
+        'sync_partition': SYNC_PARTITION,
         'face_vector': Binary(feature_bytes)
-    })
+    }
+
+
+def _get_updated_at():
+    # first_seen is when the footage was captured, which is in the past for historical files,
+    # so syncing is ordered by when the person was written instead
+    return int(time.time() * 1000)
 
 
 def list_objects(bucket, prefix, start_after=None):
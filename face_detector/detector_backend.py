@@ -0,0 +1,64 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import abc
+
+import numpy as np
+
+import metrics
+
+# names of the backends that can be passed to create_backend
+BACKENDS = ('tensorflow', 'opencv')
+
+
+class DetectorBackend(abc.ABC):
+    def __init__(self):
+        """Base class of the face detector backends. Every backend takes rgb images and returns
+        (boxes, scores, classes, num_detections) in the layout of the tensorflow object detection api
+        """
+
+        # the (width, height) the graph's fixed_shape_resizer stretches every image to, see
+        # protos/ssd_mobilenet_v1_face.config. images resized to it beforehand can share a batch
+        self.input_size = (300, 300)
+
+        # seconds spent in the most recent inference, plus running totals over all inferences
+        self.inference_time       = 0.0
+        self.total_inference_time = 0.0
+        self.inference_count      = 0
+
+    def run(self, image):
+        """image: rgb image
+        return (boxes, scores, classes, num_detections)
+        """
+
+        return self.run_batch(np.expand_dims(image, axis=0))
+
+    @abc.abstractmethod
+    def run_batch(self, images):
+        """images: [N, H, W, 3] batch of rgb images sharing a single shape
+        return (boxes, scores, classes, num_detections), each with a leading batch dimension of N
+        """
+
+    def _record_inference_time(self, elapsed_time, batch_size):
+        self.inference_time        = elapsed_time
+        self.total_inference_time += elapsed_time
+        self.inference_count      += 1
+
+        metrics.observe('detector_inference_seconds', elapsed_time)
+        metrics.increment('detector_images_total', batch_size)
+
+
+def create_backend(name):
+    """Create the detector backend with the given name. Backends are imported lazily so a
+    deployment only needs the runtime of the backend it uses"""
+    if name == 'tensorflow':
+        from .inference_usbCam_face import TensoflowFaceDector
+
+        return TensoflowFaceDector()
+
+    if name == 'opencv':
+        from .inference_opencv_face import OpenCVFaceDetector
+
+        return OpenCVFaceDetector()
+
+    raise ValueError('Unknown detector backend "%s", expected one of %s' % (name, ', '.join(BACKENDS)))
@@ -0,0 +1,88 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Generate the text graph the OpenCV backend needs to load the frozen face detection graph.
+This is run once when the model is installed, not by the detector.
+
+    python -m face_detector.generate_opencv_graph [--samples-dir DIR] [--compare image.jpg]
+
+The graph writer is part of the opencv samples. It is taken from --samples-dir, a checkout of
+opencv/samples/dnn, or otherwise downloaded for the installed opencv version.
+
+With --compare, both backends are run on the image and the largest difference between their
+boxes and scores is printed. That needs tensorflow to be installed.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import urllib.request
+
+import cv2
+
+PATH_TO_CKPT   = './face_detector/model/frozen_inference_graph_face.pb'
+PATH_TO_PBTXT  = './face_detector/model/frozen_inference_graph_face.pbtxt'
+PATH_TO_CONFIG = './face_detector/protos/ssd_mobilenet_v1_face.config'
+
+# the graph writer is part of the opencv samples rather than the opencv package, so it is
+# downloaded for the installed opencv version
+SAMPLES_URL = 'https://raw.githubusercontent.com/opencv/opencv/%s/samples/dnn/%s'
+
+
+def generate_opencv_graph(model_path=PATH_TO_CKPT, config_path=PATH_TO_CONFIG, output_path=PATH_TO_PBTXT, samples_dir=None):
+    if not os.path.isfile(model_path):
+        raise FileNotFoundError('Frozen face detection graph not found at %s' % model_path)
+
+    if samples_dir is None:
+        samples_dir = os.path.join(tempfile.gettempdir(), 'opencv-dnn-samples-%s' % cv2.__version__)
+
+        os.makedirs(samples_dir, exist_ok=True)
+
+        for sample_file in ('tf_text_graph_common.py', 'tf_text_graph_ssd.py'):
+            sample_path = os.path.join(samples_dir, sample_file)
+
+            if not os.path.isfile(sample_path):
+                urllib.request.urlretrieve(SAMPLES_URL % (cv2.__version__, sample_file), sample_path)
+
+    sys.path.insert(0, samples_dir)
+
+    try:
+        import tf_text_graph_ssd
+    finally:
+        sys.path.remove(samples_dir)
+
+    tf_text_graph_ssd.createSSDGraph(model_path, config_path, output_path)
+
+    print('Generated %s' % output_path)
+
+
+def compare_backends(image_path):
+    """Run both backends on the image and print how far apart their detections are"""
+    import numpy as np
+
+    from .detector_backend import create_backend
+
+    image = cv2.imread(image_path)
+
+    tensorflow_boxes, tensorflow_scores, _, _ = create_backend('tensorflow').run(image)
+    opencv_boxes,     opencv_scores,     _, _ = create_backend('opencv').run(image)
+
+    # only detections that either backend is confident about matter
+    count = int(max(np.sum(tensorflow_scores[0] > 0.3), np.sum(opencv_scores[0] > 0.3)))
+
+    print('Compared the top %d detections' % count)
+    print('Largest box difference:   %.4f' % np.abs(tensorflow_boxes[0, :count] - opencv_boxes[0, :count]).max(initial=0))
+    print('Largest score difference: %.4f' % np.abs(tensorflow_scores[0, :count] - opencv_scores[0, :count]).max(initial=0))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate the OpenCV text graph of the face detector')
+    parser.add_argument('--samples-dir', help='directory holding tf_text_graph_ssd.py and tf_text_graph_common.py, instead of downloading them')
+    parser.add_argument('--compare', help='image to run both backends on after generating the graph')
+
+    args = parser.parse_args()
+
+    generate_opencv_graph(samples_dir=args.samples_dir)
+
+    if args.compare is not None:
+        compare_backends(args.compare)
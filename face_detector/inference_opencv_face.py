@@ -0,0 +1,79 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# pylint: disable=C0103
+# pylint: disable=E1101
+
+import os
+import time
+
+import cv2
+import numpy as np
+
+from .detector_backend import DetectorBackend
+# the frozen detection graph is the same model used by the tensorflow backend, and the text
+# graph describes it to OpenCV
+from .generate_opencv_graph import PATH_TO_CKPT, PATH_TO_PBTXT
+
+
+class OpenCVFaceDetector(DetectorBackend):
+    def __init__(self, input_size=(300, 300), max_detections=100):
+        """OpenCV DNN detector, runs the frozen graph on the CPU without tensorflow
+        """
+
+        super(OpenCVFaceDetector, self).__init__()
+
+        self.input_size     = input_size
+        self.max_detections = max_detections
+
+        # the text graph is generated once, ahead of time, by a script that is not part of the
+        # opencv package, so it is never fetched and run when the detector starts
+        if not os.path.isfile(PATH_TO_PBTXT):
+            raise FileNotFoundError('OpenCV face detection graph not found at %s. Generate it with "python -m face_detector.generate_opencv_graph" '
+                                    'once %s is in place' % (PATH_TO_PBTXT, PATH_TO_CKPT))
+
+        self.net = cv2.dnn.readNetFromTensorflow(PATH_TO_CKPT, PATH_TO_PBTXT)
+        self.net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+        self.net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+
+    def run_batch(self, images):
+        """images: [N, H, W, 3] batch of rgb images sharing a single shape
+        return (boxes, scores, classes, num_detections), each with a leading batch dimension of N
+        """
+
+        batch_size = len(images)
+
+        # the graph's fixed_shape_resizer is not imported by OpenCV, so the images are resized to
+        # the model input here with the same bilinear interpolation. the scaling to [-1, 1] stays
+        # in the graph, so the pixels go in unscaled, and the channels are not swapped because
+        # the tensorflow backend is fed the same images as they are. "python -m
+        # face_detector.generate_opencv_graph --compare image.jpg" checks both give the same boxes
+        blob = cv2.dnn.blobFromImages(list(images), scalefactor=1.0, size=self.input_size, swapRB=False, crop=False)
+
+        # Actual detection.
+        start_time = time.time()
+        self.net.setInput(blob)
+        detections = self.net.forward()
+        elapsed_time = time.time() - start_time
+        self._record_inference_time(elapsed_time, batch_size)
+
+        # detections are [1, 1, K, 7] rows of (image_id, class, score, left, top, right, bottom)
+        # for the whole batch, split them back into tensorflow's per image layout
+        detections = detections.reshape(-1, 7)
+
+        boxes          = np.zeros((batch_size, self.max_detections, 4), dtype=np.float32)
+        scores         = np.zeros((batch_size, self.max_detections),    dtype=np.float32)
+        classes        = np.zeros((batch_size, self.max_detections),    dtype=np.float32)
+        num_detections = np.zeros((batch_size,),                        dtype=np.float32)
+
+        for i in range(batch_size):
+            image_detections = detections[detections[:, 0] == i]
+            image_detections = image_detections[np.argsort(-image_detections[:, 2])][:self.max_detections]
+
+            count = len(image_detections)
+
+            boxes[i, :count]   = image_detections[:, [4, 3, 6, 5]]
+            scores[i, :count]  = image_detections[:, 2]
+            classes[i, :count] = image_detections[:, 1]
+            num_detections[i]  = count
+
+        return (boxes, scores, classes, num_detections)
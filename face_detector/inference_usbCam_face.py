@@ -9,6 +9,7 @@ import cv2
 import numpy as np
 import tensorflow as tf
 
+from .detector_backend import DetectorBackend
 from .utils import label_map_util
 
 # Path to frozen detection graph. This is the actual model that is used for the object detection.
@@ -25,11 +26,13 @@ categories = label_map_util.convert_label_map_to_categories(label_map, max_num_c
 category_index = label_map_util.create_category_index(categories)
 
 
-class TensoflowFaceDector(object):
+class TensoflowFaceDector(DetectorBackend):
     def __init__(self):
         """Tensorflow detector
         """
 
+        super(TensoflowFaceDector, self).__init__()
+
         self.detection_graph = tf.Graph()
         with self.detection_graph.as_default():
             od_graph_def = tf.compat.v1.GraphDef()
@@ -55,6 +58,14 @@ class TensoflowFaceDector(object):
         # result image with boxes and labels on it.
         # Expand dimensions since the model expects images to have shape: [1, None, None, 3]
         image_np_expanded = np.expand_dims(image_np, axis=0)
+
+        return self.run_batch(image_np_expanded)
+
+    def run_batch(self, images):
+        """images: [N, H, W, 3] batch of rgb images sharing a single shape
+        return (boxes, scores, classes, num_detections), each with a leading batch dimension of N
+        """
+
         image_tensor = self.detection_graph.get_tensor_by_name('image_tensor:0')
         # Each box represents a part of the image where a particular object was detected.
         boxes = self.detection_graph.get_tensor_by_name('detection_boxes:0')
@@ -67,8 +78,8 @@ class TensoflowFaceDector(object):
         start_time = time.time()
         (boxes, scores, classes, num_detections) = self.sess.run(
             [boxes, scores, classes, num_detections],
-            feed_dict={image_tensor: image_np_expanded})
+            feed_dict={image_tensor: images})
         elapsed_time = time.time() - start_time
-        print('inference time cost: {}'.format(elapsed_time))
+        self._record_inference_time(elapsed_time, len(images))
 
         return (boxes, scores, classes, num_detections)
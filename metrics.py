@@ -0,0 +1,270 @@
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import bisect
+import os
+import queue
+import threading
+import time
+
+# upper bounds, in seconds, of the histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_lock       = threading.Lock()
+_counters   = defaultdict(float)
+_gauges     = {}
+_histograms = {}
+
+# the latest metrics reported by each of the other processes, by process id
+_process_metrics = {}
+
+# functions returning the current size of each watched queue, by stage name
+_watched_queues = {}
+
+
+# metrics are off until enable is called. the recording functions are no-ops until then and
+# are replaced by the real ones when metrics are enabled, so they cost nothing when off
+def increment(name, value=1, **labels):
+    pass
+
+
+def set_gauge(name, value, **labels):
+    pass
+
+
+def observe(name, seconds, **labels):
+    pass
+
+
+def enable(metrics_queue=None, report_interval=5):
+    """Start recording metrics in this process. Processes other than the one serving the metrics
+    pass the metrics queue, and their metrics are sent through it every report_interval seconds"""
+    global increment, set_gauge, observe
+
+    # a forked process starts over rather than reporting the metrics of its parent
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _histograms.clear()
+
+    increment = _increment
+    set_gauge = _set_gauge
+    observe   = _observe
+
+    if metrics_queue is not None:
+        reporter_thread        = threading.Thread(target=_report_worker, args=(metrics_queue, report_interval))
+        reporter_thread.daemon = True
+        reporter_thread.start()
+
+
+def watch_queue(stage, stage_queue):
+    """Report the depth of the queue in front of a stage"""
+    _watched_queues[stage] = stage_queue.qsize
+
+
+def serve(port=9100, metrics_queue=None, summary_interval=60):
+    """Serve the metrics of every process in the Prometheus text format on http://localhost:port/metrics
+    and print a summary every summary_interval seconds"""
+    if metrics_queue is not None:
+        collector_thread        = threading.Thread(target=_collect_worker, args=(metrics_queue,))
+        collector_thread.daemon = True
+        collector_thread.start()
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), _MetricsHandler)
+
+    server_thread        = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+
+    if summary_interval is not None:
+        summary_thread        = threading.Thread(target=_summary_worker, args=(summary_interval,))
+        summary_thread.daemon = True
+        summary_thread.start()
+
+    print('Serving metrics on http://localhost:%d/metrics' % port)
+
+
+def _increment(name, value=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+
+    with _lock:
+        _counters[key] += value
+
+
+def _set_gauge(name, value, **labels):
+    key = (name, tuple(sorted(labels.items())))
+
+    with _lock:
+        _gauges[key] = value
+
+
+def _observe(name, seconds, **labels):
+    key = (name, tuple(sorted(labels.items())))
+
+    with _lock:
+        histogram = _histograms.get(key)
+
+        if histogram is None:
+            # a count per bucket, plus one for values above the last bucket, then the sum of all values
+            histogram = [0] * (len(BUCKETS) + 1) + [0.0]
+
+            _histograms[key] = histogram
+
+        histogram[bisect.bisect_left(BUCKETS, seconds)] += 1
+        histogram[-1]                                   += seconds
+
+
+def _snapshot():
+    with _lock:
+        return dict(_counters), dict(_gauges), {key: list(histogram) for key, histogram in _histograms.items()}
+
+
+def _report_worker(metrics_queue, report_interval):
+    while True:
+        time.sleep(report_interval)
+
+        try:
+            metrics_queue.put((os.getpid(), _snapshot()), block=False)
+        except queue.Full:
+            pass
+
+
+def _collect_worker(metrics_queue):
+    while True:
+        pid, snapshot = metrics_queue.get(block=True)
+
+        with _lock:
+            _process_metrics[pid] = snapshot
+
+
+def _merge():
+    """Add up the metrics of this process and the latest metrics of every other process"""
+    counters, gauges, histograms = _snapshot()
+
+    counters   = defaultdict(float, counters)
+    histograms = {key: list(histogram) for key, histogram in histograms.items()}
+
+    with _lock:
+        process_metrics = list(_process_metrics.values())
+
+    for process_counters, process_gauges, process_histograms in process_metrics:
+        for key, value in process_counters.items():
+            counters[key] += value
+
+        gauges.update(process_gauges)
+
+        for key, histogram in process_histograms.items():
+            if key in histograms:
+                histograms[key] = [a + b for a, b in zip(histograms[key], histogram)]
+            else:
+                histograms[key] = list(histogram)
+
+    for stage, qsize in _watched_queues.items():
+        try:
+            gauges[('queue_depth', (('stage', stage),))] = qsize()
+        except NotImplementedError:
+            pass
+
+    return counters, gauges, histograms
+
+
+def _format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+
+    if len(labels) == 0:
+        return ''
+
+    return '{%s}' % ','.join('%s="%s"' % (name, value) for name, value in labels)
+
+
+def _format_prometheus():
+    counters, gauges, histograms = _merge()
+
+    lines = []
+
+    for metric_type, values in (('counter', counters), ('gauge', gauges)):
+        for name in sorted(set(name for name, _ in values)):
+            lines.append('# TYPE %s %s' % (name, metric_type))
+
+            for (metric_name, labels), value in sorted(values.items()):
+                if metric_name == name:
+                    lines.append('%s%s %s' % (name, _format_labels(labels), value))
+
+    for name in sorted(set(name for name, _ in histograms)):
+        lines.append('# TYPE %s histogram' % name)
+
+        for (metric_name, labels), histogram in sorted(histograms.items()):
+            if metric_name != name:
+                continue
+
+            # prometheus buckets count every value up to their bound
+            count = 0
+
+            for bound, bucket_count in zip(BUCKETS + ('+Inf',), histogram[:-1]):
+                count += bucket_count
+
+                lines.append('%s_bucket%s %d' % (name, _format_labels(labels, (('le', bound),)), count))
+
+            lines.append('%s_sum%s %s' % (name, _format_labels(labels), histogram[-1]))
+            lines.append('%s_count%s %d' % (name, _format_labels(labels), count))
+
+    return '\n'.join(lines) + '\n'
+
+
+def _summary_worker(summary_interval):
+    previous_counters = {}
+
+    while True:
+        time.sleep(summary_interval)
+
+        counters, gauges, histograms = _merge()
+
+        print('Metrics over the last %d seconds:' % summary_interval)
+
+        for (name, labels), value in sorted(counters.items()):
+            rate = (value - previous_counters.get((name, labels), 0)) / summary_interval
+
+            print('  %s%s: %d (%.2f/s)' % (name, _format_labels(labels), value, rate))
+
+        for (name, labels), value in sorted(gauges.items()):
+            print('  %s%s: %s' % (name, _format_labels(labels), value))
+
+        for (name, labels), histogram in sorted(histograms.items()):
+            count = sum(histogram[:-1])
+
+            if count > 0:
+                print('  %s%s: mean %.4fs, p95 under %ss' % (name, _format_labels(labels), histogram[-1] / count, _get_percentile_bound(histogram, 0.95)))
+
+        previous_counters = counters
+
+
+def _get_percentile_bound(histogram, percentile):
+    """Returns the upper bound of the bucket holding the given percentile"""
+    target = percentile * sum(histogram[:-1])
+    count  = 0
+
+    for bound, bucket_count in zip(BUCKETS + ('+Inf',), histogram[:-1]):
+        count += bucket_count
+
+        if count >= target:
+            return bound
+
+    return '+Inf'
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+
+        body = _format_prometheus().encode()
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # keep scrapes out of the logs
+        pass
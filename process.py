@@ -1,20 +1,38 @@
+from collections import defaultdict
 import datetime
+import functools
 import multiprocessing
+import os
 import queue
+import signal
 import sys
 import threading
+import time
+import uuid
 
 import cv2
+import numpy as np
 import pytz
 import urllib.request
 
 import aws
+import metrics
+import tracing
 from VideoStreamer import VideoStreamer
 from MovementDetector import MovementDetector
 from DoorHandler import DoorHandler
 from FaceDetector import FaceDetector
 from FaceFeatureGenerator import FaceFeatureGenerator
 from FaceComparer import FaceComparer
+from FaceClusterer import FaceClusterer
+from FairFrameQueue import FairFrameQueue
+from FlowTracker import FlowTracker
+from Gallery import Gallery
+from GallerySnapshot import GallerySnapshot
+from IVFIndex import IVFIndex
+from ResolutionPolicy import ResolutionPolicy
+from SharedFaceBuffer import SharedFaceBuffer
+from StageQueue import StageQueue
 
 # the names of cameras we want to process for historical data
 camera_names = [
@@ -67,6 +85,10 @@ def process_historical(update_aws):
         keys = [k for k in keys if k.endswith('.mp4')]
 
         for key in keys:
+            # a stopped streamer reads nothing more, and the file it was reading is not done
+            if video_streamer.is_stopped:
+                return
+
             if key in processed_videos:
                 continue
 
@@ -107,6 +129,9 @@ def process_historical(update_aws):
             print('Processing %s...' % file_name)
             video_streamer.start_stream(camera_name, camera_stream, start_time=start_time, delete_file=True, threaded=False)
 
+            if video_streamer.is_stopped:
+                return
+
             if update_aws:
                 aws.set_processed_video(key)
 
@@ -115,9 +140,9 @@ def process_historical(update_aws):
         start_after = keys[-1]
 
 
-def _preprocess_worker(input_queue, output_queue):
+def _preprocess_worker(input_queue, output_queue, time_of_last_movement=None):
 
-    movement_detector = MovementDetector()
+    movement_detector = MovementDetector(time_of_last_movement)
 
     while True:
         frame_metadata = input_queue.get(block=True)
@@ -126,130 +151,508 @@ def _preprocess_worker(input_queue, output_queue):
             output_queue.put(None)
             break
 
-        movement_detected = movement_detector.detect_movement(frame_metadata)
+        start_time = time.monotonic()
+
+        movement_detected, frame_metadata.motion_regions = movement_detector.detect_movement_regions(frame_metadata)
+
+        _record_stage('preprocess', start_time, [frame_metadata])
 
         if movement_detected:
             output_queue.put(frame_metadata)
+        else:
+            frame_metadata.release_frame()
+
+def _record_stage(stage, start_time, items):
+    """Record the time a stage spent on a batch of frames or faces since start_time"""
+    end_time = time.monotonic()
+
+    metrics.observe('stage_batch_seconds', end_time - start_time, stage=stage)
+    metrics.increment('items_processed_total', len(items), stage=stage)
+
+    for item in items:
+        tracing.record_span(item, stage, start_time, end_time)
+
+def _get_batch(input_queue, batch_size, batch_wait_ms, timeout=None):
+    """Block until an item is available, or for at most timeout seconds, then keep collecting
+    items until the batch is full or batch_wait_ms has passed. Returns the items, which are
+    empty if the timeout passed, and whether the None sentinel was received"""
+    try:
+        item = input_queue.get(block=True, timeout=timeout)
+    except queue.Empty:
+        return [], False
+
+    if item is None:
+        return [], True
+
+    items    = [item]
+    deadline = time.monotonic() + batch_wait_ms / 1000.0
+
+    while len(items) < batch_size:
+        timeout = deadline - time.monotonic()
+
+        if timeout <= 0:
+            break
+
+        try:
+            item = input_queue.get(block=True, timeout=timeout)
+        except queue.Empty:
+            break
+
+        if item is None:
+            return items, True
+
+        items.append(item)
 
-def _face_detection_worker(input_queue, output_queue, require_frontal_face=False, show_preview=False):
+    return items, False
+
+def _face_detection_worker(input_queue, output_queue, require_frontal_face=False, show_preview=False, batch_size=1, batch_wait_ms=20, backend='tensorflow', roi_detection=False, detection_interval=1, min_face_size=None, shared_buffer=None, detection_scale=0.5):
     # import gpu
     # gpu.init_gpus()
     # gpu.enable_mixed_precision()
 
-    detector = FaceDetector(require_frontal_face=require_frontal_face)
+    # with a min_face_size, each camera is shrunk as far as its faces allow before detection
+    resolution_policy = None
+
+    if min_face_size is not None:
+        resolution_policy = ResolutionPolicy(min_face_size=min_face_size)
+
+    detector = FaceDetector(require_frontal_face=require_frontal_face, backend=backend, resolution_policy=resolution_policy, detection_scale=detection_scale)
     # tracker  = Tracker()
 
+    # between detector runs, faces are followed with optical flow
+    flow_tracker = None
+
+    if detection_interval > 1:
+        flow_tracker = FlowTracker(detection_interval=detection_interval)
+
     while True:
-        frame_metadata = input_queue.get(block=True)
+        # frames from every camera are gathered so the detector can process them in one run
+        frames_metadata, finished = _get_batch(input_queue, batch_size, batch_wait_ms)
 
-        if frame_metadata is None:
+        if len(frames_metadata) > 0:
+            start_time = time.monotonic()
+
+            faces_per_frame = _find_faces(detector, flow_tracker, frames_metadata, roi_detection)
+
+            _record_stage('detection', start_time, frames_metadata)
+
+            metrics.increment('faces_detected_total', sum(len(faces) for faces in faces_per_frame))
+
+            for frame_metadata, faces in zip(frames_metadata, faces_per_frame):
+                # faces = tracker.match(faces, frame_metadata)
+                _output_faces(frame_metadata, faces, output_queue, show_preview, shared_buffer)
+
+        if finished:
             output_queue.put(None)
             break
 
-        faces = detector.find_faces(frame_metadata.frame)
-        # faces = tracker.match(faces, frame_metadata)
+def _find_faces(detector, flow_tracker, frames_metadata, roi_detection):
+    """Find the faces in each frame, running the detector on all frames at once. With a
+    flow tracker, only the frames it schedules are detected and the rest are tracked"""
+    frames = [frame_metadata.frame for frame_metadata in frames_metadata]
 
-        print('%d faces are detected from frame taken %d' % (len(faces), frame_metadata.timestamp))
+    # only search the moving parts of each frame for faces
+    regions = [None] * len(frames)
 
-        frame_copy = None
+    if roi_detection:
+        regions = [frame_metadata.motion_regions for frame_metadata in frames_metadata]
 
-        if show_preview:
-            frame_copy = frame_metadata.frame.copy()
+    camera_names = [frame_metadata.camera_name for frame_metadata in frames_metadata]
+
+    detect_indices = list(range(len(frames)))
+
+    if flow_tracker is not None:
+        detect_indices = [i for i, frame_metadata in enumerate(frames_metadata) if flow_tracker.schedule(frame_metadata.camera_name)]
+
+    detections = {}
+
+    if len(detect_indices) > 0:
+        detected = detector.find_boxes_batch([frames[i] for i in detect_indices], [regions[i] for i in detect_indices], [camera_names[i] for i in detect_indices])
+        detections = dict(zip(detect_indices, detected))
+
+    # frames are handled in order so each camera is tracked from its previous frame
+    for i, frame_metadata in enumerate(frames_metadata):
+        if flow_tracker is not None:
+            if i in detections:
+                flow_tracker.reset(frame_metadata.camera_name, frames[i], *detections[i])
+            else:
+                tracked = flow_tracker.update(frame_metadata.camera_name, frames[i])
 
-        del frame_metadata.frame
+                if tracked is None:
+                    # the faces were lost, so fall back to the detector for this frame
+                    tracked = detector.find_boxes(frames[i], regions[i], camera_names[i])
 
-        for face in faces:
-            face.location  = frame_metadata.camera_name
-            face.timestamp = frame_metadata.timestamp
+                    flow_tracker.reset(frame_metadata.camera_name, frames[i], *tracked)
 
-            output_queue.put((frame_metadata, face))
+                detections[i] = tracked
 
-            if show_preview:
-                x1 = face.x
-                y1 = face.y
-                x2 = face.x + face.width
-                y2 = face.y + face.height
+    crop_frames = []
+    crop_boxes  = []
 
-                cv2.rectangle(frame_copy, (x1, y1), (x2, y2), (0, 255, 0), 3)
+    # faces are cropped from the full resolution frame when the frame was scaled down for detection
+    for i, frame_metadata in enumerate(frames_metadata):
+        boxes = detections[i][0]
+
+        if frame_metadata.full_frame is not None:
+            boxes = boxes * (frame_metadata.full_frame.shape[1] / frames[i].shape[1])
+
+            crop_frames.append(frame_metadata.full_frame)
+        else:
+            crop_frames.append(frames[i])
+
+        crop_boxes.append(boxes)
+
+    return detector.crop_faces_batch(crop_frames, crop_boxes, [detections[i][1] for i in range(len(frames))])
+
+def _output_faces(frame_metadata, faces, output_queue, show_preview, shared_buffer=None):
+    print('%d faces are detected from frame taken %d' % (len(faces), frame_metadata.timestamp))
+
+    frame_copy = None
+
+    # the preview is drawn on a BGR copy since the frame buffer is recycled once it is released
+    if show_preview:
+        frame_copy = cv2.cvtColor(frame_metadata.frame if frame_metadata.full_frame is None else frame_metadata.full_frame, cv2.COLOR_RGB2BGR)
+
+    frame_metadata.release_frame()
+
+    for face in faces:
+        face.location  = frame_metadata.camera_name
+        face.timestamp = frame_metadata.timestamp
+
+        face.capture_time = frame_metadata.capture_time
+        face.trace_id     = frame_metadata.trace_id
+        face.stage_times  = dict(frame_metadata.stage_times)
+
+        if shared_buffer is not None:
+            shared_buffer.store_crop(face)
+
+        output_queue.put((frame_metadata, face))
 
         if show_preview:
-            cv2.namedWindow(frame_metadata.camera_name, cv2.WINDOW_NORMAL)
-            cv2.resizeWindow(frame_metadata.camera_name, 800, 600)
+            x1 = face.x
+            y1 = face.y
+            x2 = face.x + face.width
+            y2 = face.y + face.height
 
-            frame_copy = cv2.cvtColor(frame_copy, cv2.COLOR_RGB2BGR)
+            cv2.rectangle(frame_copy, (x1, y1), (x2, y2), (0, 255, 0), 3)
 
-            cv2.imshow(frame_metadata.camera_name, frame_copy)
-            cv2.waitKey(1)
+    if show_preview:
+        cv2.namedWindow(frame_metadata.camera_name, cv2.WINDOW_NORMAL)
+        cv2.resizeWindow(frame_metadata.camera_name, 800, 600)
 
-def _face_features_worker(input_queue, output_queue):
+        cv2.imshow(frame_metadata.camera_name, frame_copy)
+        cv2.waitKey(1)
+
+def _face_features_worker(input_queue, output_queue, batch_size=1, batch_wait_ms=20, num_jitters=5, shared_buffer=None, metrics_queue=None, trace_file=None, trace_sample_rate=0.01, refine_jitters=None, snapshot_directory=None, ann_probes=None):
     # import gpu
     # gpu.init_gpus()
     # gpu.enable_mixed_precision()
 
-    feature_generator = FaceFeatureGenerator()
+    if metrics_queue is not None:
+        metrics.enable(metrics_queue)
+
+    if trace_file is not None:
+        tracing.enable(trace_file, trace_sample_rate, 'face features %d' % os.getpid())
+
+    feature_generator = FaceFeatureGenerator(num_jitters=num_jitters)
+
+    # with refine_jitters, faces whose closest known person is close to the matching threshold
+    # are described again with that many jitters. the known people are followed through the
+    # gallery snapshot the comparison worker appends new people to and saves refinements to
+    face_comparer     = None
+    known_people      = None
+    gallery_snapshot  = None
+    refinements_mtime = None
+
+    if refine_jitters is not None:
+        face_comparer    = FaceComparer()
+        known_people     = Gallery(index=None if ann_probes is None else IVFIndex(num_probes=ann_probes))
+        gallery_snapshot = GallerySnapshot(snapshot_directory, read_only=True)
+
+        refinements_mtime = gallery_snapshot.refinements_mtime
+
+        gallery_snapshot.load(known_people)
 
     while True:
-        item = input_queue.get(block=True)
+        # faces are gathered so the network can process them in one call
+        items, finished = _get_batch(input_queue, batch_size, batch_wait_ms)
 
-        if item is None:
+        if len(items) > 0:
+            start_time = time.monotonic()
+
+            if shared_buffer is not None:
+                for frame_metadata, face in items:
+                    face.crop = shared_buffer.load_crop(face)
+
+            faces    = [face for frame_metadata, face in items]
+            features = feature_generator.generate_features_batch(faces)
+
+            for face, face_features in zip(faces, features):
+                face.features    = face_features
+                face.num_jitters = num_jitters
+
+            if refine_jitters is not None:
+                # only the people found since the last batch are added, and the centroids and
+                # templates are only reloaded when they have been saved again
+                gallery_snapshot.load_new(known_people)
+
+                if gallery_snapshot.refinements_mtime != refinements_mtime:
+                    refinements_mtime = gallery_snapshot.refinements_mtime
+
+                    gallery_snapshot.load_refinements(known_people)
+
+                _refine_ambiguous_faces(faces, feature_generator, face_comparer, known_people, refine_jitters)
+
+            _record_stage('features', start_time, faces)
+
+            for frame_metadata, face in items:
+                metrics.increment('faces_described_total', jitters=face.num_jitters)
+
+                # the crop and features stay in the slot, only the slot number is sent on
+                if shared_buffer is not None and face.slot is not None:
+                    face.crop = None
+
+                    shared_buffer.store_features(face)
+
+                print('Extracted 128d feature vector of face:%s of frame %d' % (face.id, frame_metadata.timestamp))
+
+                output_queue.put((frame_metadata, face))
+
+        if finished:
             output_queue.put(None)
 
+            if shared_buffer is not None:
+                shared_buffer.close()
+
             break
 
-        frame_metadata, face = item
+def _refine_ambiguous_faces(faces, feature_generator, face_comparer, known_people, refine_jitters):
+    """Describe the faces whose closest known person could go either way again with refine_jitters"""
+    _, closest_distances = face_comparer.find_closest_batch(np.stack([face.features for face in faces]), known_people)
 
-        face.features = feature_generator.generate_features(face)
+    for face, closest_distance in zip(faces, closest_distances):
+        if face_comparer.is_ambiguous(closest_distance):
+            face.features    = feature_generator.generate_features(face, refine_jitters).astype(np.float32)
+            face.num_jitters = refine_jitters
 
-        print('Extracted 128d feature vector of face:%s of frame %d' % (face.id, frame_metadata.timestamp))
+def _face_comparison_worker(input_queue, door_open_queue, aws_update_queue=None, debug_logs=False, ann_probes=None, batch_size=1, batch_wait_ms=20, snapshot_directory=None, cluster_window_ms=None, shared_buffer=None, metrics_queue=None, trace_file=None, trace_sample_rate=0.01, cluster_max_faces=1000, cluster_max_wait_ms=10000):
+    if metrics_queue is not None:
+        metrics.enable(metrics_queue)
 
-        output_queue.put((frame_metadata, face))
+    if trace_file is not None:
+        tracing.enable(trace_file, trace_sample_rate, 'face comparison')
+
+    # with ann_probes, large galleries are searched through an approximate nearest neighbour
+    # index that only compares faces against the people in the ann_probes closest clusters
+    gallery_index = None
+
+    if ann_probes is not None:
+        gallery_index = IVFIndex(num_probes=ann_probes)
+
+    known_people = Gallery(index=gallery_index)
 
-def _face_comparison_worker(input_queue, door_open_queue, aws_update_queue=None, debug_logs=False):
-    known_people = {}
+    # with a snapshot directory, known people are memory mapped from the local snapshot and
+    # only the people added to the people table since the snapshot was last synced are fetched
+    gallery_snapshot = None
 
-    aws.get_known_people(known_people)
+    if snapshot_directory is not None:
+        gallery_snapshot = GallerySnapshot(snapshot_directory)
+
+        print('Loaded %d known people from snapshot' % gallery_snapshot.load(known_people))
+
+        _sync_gallery_snapshot(gallery_snapshot, known_people)
+    else:
+        aws.get_known_people(known_people)
 
     face_comparer = FaceComparer()
 
+    # with cluster_window_ms, historical faces are collected until their timestamps span that
+    # long and clustered together before being matched, instead of being matched in the order
+    # they arrive. a window is cut short at cluster_max_faces faces, or after it has been
+    # collecting for cluster_max_wait_ms, as faces of several files arrive interleaved
+    face_clusterer   = None
+    historical_items = []
+
+    historical_first_timestamp = None
+    historical_last_timestamp  = None
+    historical_window_start    = None
+
+    if cluster_window_ms is not None:
+        face_clusterer = FaceClusterer(min_distance=face_comparer.min_distance)
+
+    # the centroids and templates of refined people are saved to the snapshot at most once a minute
+    saved_refinements    = known_people.refinements
+    last_refinement_save = time.monotonic()
+
     print('made face comparer')
 
     while True:
-        item = input_queue.get(block=True)
+        # a partly filled window of historical faces is clustered once it has waited
+        # cluster_max_wait_ms, even if no more faces arrive
+        timeout = None
 
-        if item is None:
+        if len(historical_items) > 0:
+            timeout = max(historical_window_start + cluster_max_wait_ms / 1000.0 - time.monotonic(), 0)
+
+        # faces are gathered so they can be matched against the known people at once
+        items, finished = _get_batch(input_queue, batch_size, batch_wait_ms, timeout)
+
+        start_time = time.monotonic()
+
+        if shared_buffer is not None:
+            for frame_metadata, face in items:
+                face.features = shared_buffer.load_features(face)
+
+                # only saved faces need the crop, which is copied out of the slot
+                if aws_update_queue is not None:
+                    face.crop = shared_buffer.load_crop(face).copy()
+
+                shared_buffer.release(face)
+
+        if face_clusterer is not None:
+            for frame_metadata, face in items:
+                if frame_metadata.is_live:
+                    continue
+
+                if len(historical_items) == 0:
+                    historical_first_timestamp = face.timestamp
+                    historical_last_timestamp  = face.timestamp
+                    historical_window_start    = time.monotonic()
+
+                historical_first_timestamp = min(historical_first_timestamp, face.timestamp)
+                historical_last_timestamp  = max(historical_last_timestamp,  face.timestamp)
+
+                historical_items.append((frame_metadata, face))
+
+            items = [item for item in items if item[0].is_live]
+
+            if len(historical_items) > 0 and (finished or historical_last_timestamp - historical_first_timestamp >= cluster_window_ms or len(historical_items) >= cluster_max_faces or (time.monotonic() - historical_window_start) * 1000 >= cluster_max_wait_ms):
+                _cluster_historical_faces(historical_items, face_clusterer, face_comparer, known_people, gallery_snapshot, door_open_queue, aws_update_queue, debug_logs)
+
+                historical_items = []
+
+        if len(items) > 0:
+            faces = [face for frame_metadata, face in items]
+
+            print('Matching %d faces' % len(faces))
+            person_ids, is_new_person = face_comparer.match_faces(np.stack([face.features for face in faces]), known_people)
+
+            _record_stage('comparison', start_time, faces)
+
+            for (frame_metadata, face), person_id, is_new in zip(items, person_ids, is_new_person):
+                face.person_id     = person_id
+                face.is_new_person = is_new
+
+                _handle_match(frame_metadata, face, known_people, gallery_snapshot, door_open_queue, aws_update_queue, debug_logs)
+
+        if gallery_snapshot is not None and known_people.refinements != saved_refinements and (finished or time.monotonic() - last_refinement_save >= 60):
+            gallery_snapshot.save_refinements(known_people)
+
+            saved_refinements    = known_people.refinements
+            last_refinement_save = time.monotonic()
+
+        if finished:
             if aws_update_queue is not None:
                 aws_update_queue.put(None)
 
+            if shared_buffer is not None:
+                shared_buffer.close()
+
             break
 
-        frame_metadata, face = item
+def _cluster_historical_faces(items, face_clusterer, face_comparer, known_people, gallery_snapshot, door_open_queue, aws_update_queue, debug_logs):
+    """Cluster a window of historical faces, then match every cluster against the known people as a whole"""
+    start_time = time.monotonic()
+
+    features_matrix = np.stack([face.features for frame_metadata, face in items])
+
+    labels    = face_clusterer.cluster(features_matrix)
+    centroids = face_clusterer.cluster_centroids(features_matrix, labels)
+
+    person_ids, distances = face_comparer.find_closest_batch(centroids, known_people)
+
+    print('Clustered %d historical faces into %d people' % (len(items), len(centroids)))
 
-        print('Matching face %s' % face.id)
-        face = face_comparer.match_face(face, known_people)
+    _record_stage('comparison', start_time, [face for frame_metadata, face in items])
+
+    # clusters that match nobody are new people
+    is_new_cluster = distances >= face_comparer.min_distance
+
+    cluster_person_ids = [str(uuid.uuid4()) if is_new else person_id for person_id, is_new in zip(person_ids, is_new_cluster)]
+
+    faces = []
+
+    for (frame_metadata, face), label in zip(items, labels):
+        face.person_id = cluster_person_ids[label]
+
+        # the first face of a new cluster introduces the new person. it stands for the whole
+        # cluster, so it carries the cluster centroid into the gallery and the people table
+        face.is_new_person = bool(is_new_cluster[label]) and face.person_id not in known_people
 
         if face.is_new_person:
-            if debug_logs:
-                print('New person found, giving ID %s' % face.person_id)
+            face.features = centroids[label].astype(np.float32)
 
-            # make a copy to prevent reference leak
-            known_people[face.person_id] = (-1, face.features.copy())
+        _handle_match(frame_metadata, face, known_people, gallery_snapshot, door_open_queue, None, debug_logs)
 
-            # update known people asynchronously
-            # aws.get_known_people(known_people)
-        else:
-            if debug_logs:
-                print('Found person with ID %s' % face.person_id)
+        faces.append(face)
+
+    metrics.increment('historical_clusters_total', len(centroids))
+
+    # save the whole window with one bulk write
+    if aws_update_queue is not None:
+        aws_update_queue.put(faces)
+
+def _sync_gallery_snapshot(gallery_snapshot, known_people):
+    """Add the people written to the people table since the last sync to the gallery and the
+    snapshot, and update the entities assigned to people already in them"""
+    people = aws.get_people_updated_since(gallery_snapshot.synced_until)
+
+    synced_until = gallery_snapshot.synced_until
+
+    for person_id, entity_id, face_vector, updated_at in people:
+        # people found by this process, or read by an earlier sync, are already in the snapshot
+        if person_id not in known_people:
+            known_people.add(person_id, entity_id, face_vector)
+            gallery_snapshot.append(person_id, entity_id, face_vector)
+        elif known_people[person_id][0] != entity_id:
+            known_people.set_entity_id(person_id, entity_id)
+            gallery_snapshot.set_entity_id(person_id, entity_id)
+
+        synced_until = max(synced_until, updated_at)
+
+    gallery_snapshot.synced_until = synced_until
+
+    print('Synced %d people added or changed since the last snapshot' % len(people))
+
+def _handle_match(frame_metadata, face, known_people, gallery_snapshot, door_open_queue, aws_update_queue, debug_logs):
+    if face.is_new_person:
+        if debug_logs:
+            print('New person found, giving ID %s' % face.person_id)
+
+        # make a copy to prevent reference leak
+        known_people[face.person_id] = (-1, face.features.copy())
+
+        metrics.increment('new_people_total')
+
+        if gallery_snapshot is not None:
+            gallery_snapshot.append(face.person_id, -1, face.features)
 
-            if not frame_metadata.is_live:
-                entity_id, _ = known_people[face.person_id]
+        # update known people asynchronously
+        # aws.get_known_people(known_people)
+    else:
+        if debug_logs:
+            print('Found person with ID %s' % face.person_id)
 
-                print("Entity id is %d" % entity_id)
-                entity_id = 1
-                if entity_id != -1:
-                    door_open_queue.put((face.person_id, frame_metadata.camera_name))
+        if not frame_metadata.is_live:
+            entity_id, _ = known_people[face.person_id]
 
-        if aws_update_queue is not None:
-            aws_update_queue.put(face)
+            print("Entity id is %d" % entity_id)
+            entity_id = 1
+            if entity_id != -1:
+                door_open_queue.put((face.person_id, frame_metadata.camera_name, face.capture_time, face.trace_id, face.stage_times))
+
+    if aws_update_queue is not None:
+        aws_update_queue.put(face)
 
 if __name__ == '__main__':
     debug_logs            = True
@@ -260,37 +663,198 @@ if __name__ == '__main__':
     require_frontal_face  = False
     threaded_live_streams = True
 
+    # frames from up to detection_batch_size cameras arriving within detection_batch_wait_ms
+    # of each other are run through the face detector together
+    detection_batch_size    = 1
+    detection_batch_wait_ms = 20
+
+    # faces arriving within feature_batch_wait_ms of each other are passed through the
+    # feature network together, up to feature_batch_size at a time
+    feature_batch_size    = 16
+    feature_batch_wait_ms = 20
+
+    # describe faces with a single pass first, and only spend adaptive_jitters passes on
+    # faces whose closest match is close to the matching threshold. None always uses 5 jitters.
+    # the feature workers follow the known people through the gallery snapshot, so this
+    # needs gallery_snapshot_directory
+    adaptive_jitters = None
+
+    # search known people through an inverted file index once there are enough of them,
+    # probing this many clusters per face. more probes find the true closest person more
+    # often at the cost of speed. None always compares faces against every known person
+    ann_probes = None
+
+    # faces arriving within comparison_batch_wait_ms of each other are matched together, up
+    # to comparison_batch_size at a time. new faces in the same batch that look alike share an id
+    comparison_batch_size    = 16
+    comparison_batch_wait_ms = 20
+
+    # directory of the local known people snapshot, which is loaded on start and appended to
+    # as people are found. None downloads every known person from the people table instead
+    gallery_snapshot_directory = None
+
+    # cluster historical faces in windows of this many milliseconds of footage and give each
+    # cluster one person id, rather than matching the faces one by one as they arrive. a window
+    # is also clustered once it holds historical_cluster_max_faces faces or has been collecting
+    # for historical_cluster_max_wait_ms. None matches historical faces like live ones
+    historical_cluster_window_ms   = None
+    historical_cluster_max_faces   = 1000
+    historical_cluster_max_wait_ms = 10000
+
+    # pass face crops and features between the processes through this many slots of shared
+    # memory rather than pickling them into the queues. None sends them through the queues
+    shared_memory_slots = None
+
+    # the number of workers of each stage. preprocessing and detection run in threads, feature
+    # extraction in processes. comparison always has a single worker so there is only one
+    # authoritative gallery of known people
+    preprocess_workers = 1
+    detection_workers  = 1
+    feature_workers    = 1
+
+    # send the frames and faces of a camera to the same worker of each pool so they are
+    # processed in order, which the movement detector and flow tracker rely on
+    ordered_by_camera = True
+
+    # frames waiting to be preprocessed or detected are taken from the cameras in turn. live
+    # frames are dropped once they are older than live_frame_max_age_ms, or when the queue
+    # is full, so live cameras stay real time. historical frames are never dropped
+    live_frame_max_age_ms = 2000
+
+    # cameras that have not moved for idle_after_ms are only sampled every idle_frame_interval
+    # frames instead of every 3rd frame. None samples every 3rd frame all the time
+    idle_frame_interval = None
+    idle_after_ms       = 30000
+
+    # have gstreamer scale streams down to stream_width pixels wide and drop frames down to
+    # stream_fps before they are converted to BGR. None keeps the stream's own size and rate.
+    # with full_resolution_crops, faces are still cropped from full resolution frames
+    stream_width          = None
+    stream_fps            = None
+    full_resolution_crops = False
+
+    # failed live streams are reconnected after a random delay of up to min_reconnect_delay
+    # seconds, doubling with each failure in a row up to max_reconnect_delay. the uptime, frame
+    # rate and decode errors of every camera are printed every stream_stats_interval seconds
+    min_reconnect_delay   = 1
+    max_reconnect_delay   = 300
+    stream_stats_interval = 600
+
+    # 'frames' keeps every 3rd frame of historical files like live streams do. 'stride' and
+    # 'seek' sample them every historical_sample_ms of video instead. 'stride' decodes every
+    # frame and keeps the samples, 'seek' seeks from one sample to the next so most frames
+    # between them are never decoded, and falls back to 'stride' for files it can not seek in
+    historical_sampling  = 'frames'
+    historical_sample_ms = 500
+
+    # frames are scaled by detection_scale before detection. 1.0 suits frames that
+    # stream_width has already scaled down
+    detection_scale = 0.5
+
+    # serve queue depths, stage times, dropped frames, face rates and door open latency on
+    # http://localhost:metrics_port/metrics and print a summary every metrics_summary_interval
+    # seconds. None turns metrics off
+    metrics_port             = None
+    metrics_summary_interval = 60
+
+    # write the stages of a trace_sample_rate fraction of the frames, from capture to door open
+    # and aws update, to trace_file. it can be opened in chrome://tracing or https://ui.perfetto.dev.
+    # None turns tracing off
+    trace_file        = None
+    trace_sample_rate = 0.01
+
+    # 'tensorflow' runs the frozen graph in a tensorflow session, 'opencv' runs it with the
+    # OpenCV DNN module on the CPU, which does not need tensorflow to be installed
+    detector_backend = 'tensorflow'
+
+    # run the face detector on a padded crop around the moving region of each frame, so small
+    # faces in it keep more detail. this costs the same as detecting the whole frame, and frames
+    # that move in more than one place are still detected whole
+    roi_detection = False
+
+    # run the face detector on every detection_interval-th frame of each camera, or when
+    # tracks are lost, and follow the faces with optical flow in between. 1 detects every frame
+    detection_interval = 1
+
+    # learn per camera whether its faces reach the 300x300 detector input with at least
+    # min_face_size pixels, and only shrink the frames of the cameras where they do. None
+    # always halves the frames before detection. frames are never shrunk below the input
+    min_face_size = None
+
+    if adaptive_jitters is not None and gallery_snapshot_directory is None:
+        raise ValueError('adaptive_jitters needs a gallery_snapshot_directory to follow the known people from')
+
     # limit queue size to prevent memory overflow
-    preprocess_queue      = queue.Queue(maxsize=32)
-    face_detection_queue  = queue.Queue(maxsize=32)
-    face_feature_queue    = multiprocessing.Queue(maxsize=32)
-    face_comparison_queue = multiprocessing.Queue(maxsize=32)
+    frame_queue_type = functools.partial(FairFrameQueue, max_age_ms=live_frame_max_age_ms)
+
+    preprocess_queue      = StageQueue(1,                  preprocess_workers, ordered_by_camera=ordered_by_camera, queue_type=frame_queue_type)
+    face_detection_queue  = StageQueue(preprocess_workers, detection_workers,  ordered_by_camera=ordered_by_camera, queue_type=frame_queue_type)
+    face_feature_queue    = StageQueue(detection_workers,  feature_workers,    multiprocess=True)
+    face_comparison_queue = StageQueue(feature_workers,    1,                  multiprocess=True)
     door_open_queue = multiprocessing.Queue(maxsize=32)
 
     aws_update_queue  = None
     aws_update_thread = None
 
+    # the worker processes send their metrics to this process, which serves them
+    metrics_queue = None
+
+    if metrics_port is not None:
+        metrics_queue = multiprocessing.Queue(maxsize=32)
+
+        metrics.enable()
+        metrics.serve(metrics_port, metrics_queue, metrics_summary_interval)
+
+        metrics.watch_queue('preprocess', preprocess_queue)
+        metrics.watch_queue('detection',  face_detection_queue)
+        metrics.watch_queue('features',   face_feature_queue)
+        metrics.watch_queue('comparison', face_comparison_queue)
+
+    if trace_file is not None:
+        tracing.enable(trace_file, trace_sample_rate, 'main', create=True)
+
+    shared_buffer = None
+
+    if shared_memory_slots is not None:
+        shared_buffer = SharedFaceBuffer(num_slots=shared_memory_slots)
+
     if update_aws:
         aws_update_queue = multiprocessing.Queue(maxsize=32)
 
         aws_update_thread = threading.Thread(target=aws.aws_update_worker, args=(aws_update_queue,))
         aws_update_thread.start()
 
-    video_streamer = VideoStreamer(preprocess_queue, debug_logs=debug_logs)
+    # the movement detectors record the last movement of each camera, which the video
+    # streamer reads to decide how often to sample the camera
+    time_of_last_movement = defaultdict(int)
+
+    video_streamer = VideoStreamer(preprocess_queue, debug_logs=debug_logs, idle_frame_interval=idle_frame_interval, idle_after_ms=idle_after_ms, time_of_last_movement=time_of_last_movement, output_width=stream_width, output_fps=stream_fps, full_resolution_crops=full_resolution_crops, min_reconnect_delay=min_reconnect_delay, max_reconnect_delay=max_reconnect_delay, stats_interval=stream_stats_interval, historical_sampling=historical_sampling, historical_sample_ms=historical_sample_ms)
+
+    workers = []
+
+    for i in range(preprocess_workers):
+        workers.append(threading.Thread(target=_preprocess_worker, args=(preprocess_queue.get_queue(i), face_detection_queue, time_of_last_movement)))
+
+    for i in range(detection_workers):
+        workers.append(threading.Thread(target=_face_detection_worker, args=(face_detection_queue.get_queue(i), face_feature_queue, require_frontal_face, show_preview, detection_batch_size, detection_batch_wait_ms, detector_backend, roi_detection, detection_interval, min_face_size, shared_buffer, detection_scale)))
 
-    preprocess_worker      = threading.Thread(target=_preprocess_worker,             args=(preprocess_queue,      face_detection_queue))
-    face_detection_worker  = threading.Thread(target=_face_detection_worker,         args=(face_detection_queue,  face_feature_queue, require_frontal_face, show_preview))
-    face_features_worker   = multiprocessing.Process(target=_face_features_worker,   args=(face_feature_queue,    face_comparison_queue))
-    face_comparison_worker = multiprocessing.Process(target=_face_comparison_worker, args=(face_comparison_queue, door_open_queue, aws_update_queue, debug_logs))
+    for i in range(feature_workers):
+        workers.append(multiprocessing.Process(target=_face_features_worker, args=(face_feature_queue.get_queue(i), face_comparison_queue, feature_batch_size, feature_batch_wait_ms, 5 if adaptive_jitters is None else 0, shared_buffer, metrics_queue, trace_file, trace_sample_rate, adaptive_jitters, gallery_snapshot_directory, ann_probes)))
 
-    preprocess_worker.start()
-    face_detection_worker.start()
-    face_features_worker.start()
-    face_comparison_worker.start()
+    face_comparison_worker = multiprocessing.Process(target=_face_comparison_worker, args=(face_comparison_queue.get_queue(0), door_open_queue, aws_update_queue, debug_logs, ann_probes, comparison_batch_size, comparison_batch_wait_ms, gallery_snapshot_directory, historical_cluster_window_ms, shared_buffer, metrics_queue, trace_file, trace_sample_rate, historical_cluster_max_faces, historical_cluster_max_wait_ms))
+
+    workers.append(face_comparison_worker)
+
+    for worker in workers:
+        worker.start()
 
     door_handler  = DoorHandler()
     door_handler.start_door_open_thread(door_open_queue)
 
+    # on SIGTERM the streams stop being read, and the frames already read drain through the
+    # workers before they exit. it is set after the workers start so they keep the default handler
+    signal.signal(signal.SIGTERM, lambda signum, frame: video_streamer.stop())
+
     if live:
         for camera_name, camera_stream in cameras:
             video_streamer.start_stream(camera_name, camera_stream, start_time=None, delete_file=False, threaded=threaded_live_streams)
@@ -306,5 +870,8 @@ if __name__ == '__main__':
 
     face_comparison_worker.join()
 
+    if shared_buffer is not None:
+        shared_buffer.close()
+
     if update_aws:
         aws_update_thread.join()
@@ -0,0 +1,78 @@
+import json
+import os
+import random
+import threading
+import time
+import uuid
+
+# a sample of the frames are traced through the pipeline. each stage of a traced frame, and of
+# the faces found in it, is written to one file shared by every process as a chrome trace
+# event, so a run can be opened in chrome://tracing or https://ui.perfetto.dev. times are taken
+# from time.monotonic(), which is the same clock in every process
+_trace_file  = None
+_sample_rate = 0.0
+_lock        = threading.Lock()
+
+
+def enable(trace_file, sample_rate=0.01, process_name=None, create=False):
+    """Start tracing in this process. The process that starts the run creates the trace file,
+    the others append to it"""
+    global _trace_file, _sample_rate
+
+    # the trace is a json array that is never closed, which trace viewers accept
+    if create:
+        with open(trace_file, 'w') as f:
+            f.write('[\n')
+
+    _trace_file  = open(trace_file, 'a', buffering=1)
+    _sample_rate = sample_rate
+
+    if process_name is not None:
+        _write({'name': 'process_name', 'ph': 'M', 'pid': os.getpid(), 'args': {'name': process_name}})
+
+
+def start_trace():
+    """Returns a trace id if the next frame is sampled, otherwise None"""
+    if _trace_file is None or random.random() >= _sample_rate:
+        return None
+
+    return uuid.uuid4().hex[:16]
+
+
+def record_span(item, name, start_time, end_time=None):
+    """Record a stage of a traced frame or face that ran from start_time to end_time, or to now.
+    The time it waited since its previous stage is recorded as well"""
+    if item.trace_id is None or _trace_file is None:
+        return
+
+    if end_time is None:
+        end_time = time.monotonic()
+
+    if len(item.stage_times) > 0:
+        previous_end_time = max(end for _, end in item.stage_times.values())
+
+        if start_time > previous_end_time:
+            _write_span(item.trace_id, 'waiting for %s' % name, previous_end_time, start_time)
+
+    item.stage_times[name] = (start_time, end_time)
+
+    _write_span(item.trace_id, name, start_time, end_time)
+
+
+def _write_span(trace_id, name, start_time, end_time):
+    _write({
+        'name': name,
+        'cat': 'frame',
+        'ph': 'X',
+        'ts': start_time * 1e6,
+        'dur': (end_time - start_time) * 1e6,
+        'pid': os.getpid(),
+        'tid': threading.get_ident(),
+        'args': {'trace_id': trace_id}
+    })
+
+
+def _write(event):
+    # each event is a single short line, so lines appended by different processes do not mix
+    with _lock:
+        _trace_file.write(json.dumps(event) + ',\n')